@@ -54,7 +54,10 @@ import logging
 import argparse
 import re
 import csv
-from xml.etree import ElementTree as et
+import functools
+import itertools
+import concurrent.futures
+from lxml import etree as et
 
 # This next section is plagurised from /usr/include/sysexits.h
 EX_OK = 0               # successful termination
@@ -77,27 +80,19 @@ EX_NOPERM = 77          # permission denied
 EX_CONFIG = 78          # configuration error
 
 Segments = []           # The Segments in the message being converted
-segmentNo = 0           # The next segment in the message to be converted
-segmentRoot = None      # The XML Schema for the segments
-fieldRoot = None        # The XML Schema for the fields
-dataTypeRoot = None     # The XML Schema for the data types
-messageRoot = None      # The XML Schema for the message being converted
-namespaces = None       # The namespaces of the XML Schemas
+segmentFields = []      # The segment name and the fields for each of the Segments
+segmentFieldTypes = {}  # The (field, data type) of each field in each segment - None if not a ref
+dataTypeComponents = {} # The (component, data type, subcomponents) of each component of each (composite) data type
+hl7messageStructures = {}   # The message structure for each message type and trigger event
+namespaces = {'xsd':'http://www.w3.org/2001/XMLSchema'}     # The namespaces of the XML Schemas
+xsdParser = et.XMLParser(remove_blank_text=True, remove_comments=True, remove_pis=True)     # The parser for the XML Schemas
 fieldSep = None         # The field separator character
 repSep = None           # The repeat separator
 compSep = None          # The component separator
 subCompSep = None       # The subcomponent separator
-xmlReplacements = [
-    re.compile(r'\\(H)\\'),
-    re.compile(r'\\(N)\\'),
-    re.compile(r'\\(\.br)\\'),
-    re.compile(r'\\(\.sp\s*\d+)\\'),
-    re.compile(r'\\(\.in\s*[-+]?\d+)\\'),
-    re.compile(r'\\(\.ti\s*[-+]?\d+)\\')
-]
-charXref = re.compile(r'\\X([0-9A-Fa-f][0-9A-Fa-f])+\\')
-charZref = re.compile(r'\\Z([0-9A-Fa-f][0-9A-Fa-f])+\\')
-hl7charRef = re.compile(r'&amp;(#x([0-9A-Fa-f][0-9A-Fa-f])+;)')
+xmlEscape = re.compile(r'\\(H|N|\.br|\.sp\s*\d+|\.in\s*[-+]?\d+|\.ti\s*[-+]?\d+)\\')     # The escape sequences that become <escape V="..."/>
+escapeTypes = frozenset(['TX', 'FT', 'CF'])     # The data types that can contain escape sequences
+charRef = re.compile(r'\\[XZ]((?:[0-9A-Fa-f][0-9A-Fa-f])+)\\')      # The \Xdddd\ and \Zdddd\ escape sequences
 
 
 
@@ -105,184 +100,315 @@ def getDocument(fileName):
     '''
     Get an HL7 vertical bar message from a file or standard input
     '''
-    thisHL7message = ''
     if fileName == '-':     # Use standard input
-        for line in sys.stdin:
-            thisHL7message += line.rstrip() + '\n'
-        return thisHL7message
+        return ''.join([line.rstrip() + '\r' for line in sys.stdin])
     if not os.path.isfile(fileName):
         logging.fatal('No file named %s', fileName)
         logging.shutdown()
         sys.exit(EX_CONFIG)
     with open(fileName, 'rt', encoding='utf-8') as fpin:
-        for line in fpin:
-            thisHL7message += line.rstrip() + '\r'
-        return thisHL7message
+        return ''.join([line.rstrip() + '\r' for line in fpin])
 
 
-def createXML(sequenceList, tag, optional, isChoice, depth):
+def readSchema(xsdFile, suffix):
     '''
-    Output an XML structure for all the elements in the sequence list where we have a matching segment in the Segments.
+    Read an XML Schema and build dictionaries of the xsd:complexType sequences and the xsd:attributeGroup 'Type' attributes
+    The XML Schema is read with iterparse() and each definition is discarded once it has been indexed,
+    so only the dictionaries, and not the whole XML Schema, are kept in memory
     PARAMETERS:
-        xmlElement - et.Element, the current element we are working on
-        sequenceList - et.Element,the XML sequence we are working on, from the message structure XSD
-        sequenceAt - int, how far we are through this sequence list
-        tag - str, the group tag, if any
-        optional - boolean whether no output is valid
-        depth - int, the recursion depth
-    This is a recursive routine, so we use depth to prevent indifinite recurrsion
+        xsdFile - str, the XML Schema file
+        suffix - str, the suffix to strip from the complexType names (e.g. '.CONTENT')
+    RETURNS:
+        sequences - dict, the element refs in the xsd:sequence for each complexType name (less the suffix) - None if not a ref
+        types - dict, the data type for each field/component (the attributeGroup name less '.ATTRIBUTES')
     '''
+    sequences = {}
+    types = {}
+    xsd = '{' + namespaces['xsd'] + '}'
+    for event, definition in et.iterparse(xsdFile, events=('end',), tag=(xsd + 'complexType', xsd + 'attributeGroup'),
+                                          remove_blank_text=True, remove_comments=True, remove_pis=True):
+        if definition.getparent().getparent() is not None:      # Only top level definitions are wanted
+            continue
+        name = definition.attrib.get('name')
+        if name is None:
+            pass
+        elif definition.tag == xsd + 'complexType':
+            sequence = definition.find('xsd:sequence', namespaces)
+            if (sequence is not None) and name.endswith(suffix):
+                if suffix != '':
+                    name = name[:-len(suffix)]
+                sequences[name] = tuple([element.attrib.get('ref') for element in sequence])
+        elif name.endswith('.ATTRIBUTES'):
+            typeAttribute = definition.find("xsd:attribute[@name='Type']", namespaces)
+            if (typeAttribute is not None) and ('fixed' in typeAttribute.attrib):
+                types[name[:-11]] = typeAttribute.attrib['fixed']
+        # Discard this definition, and any that came before it
+        definition.clear()
+        while definition.getprevious() is not None:
+            del definition.getparent()[0]
+    return sequences, types
+
+
+def compileStructure(messageRoot):
+    '''
+    Compile the message structure XML Schema into a table of the segments and segment groups in each group
+    PARAMETERS:
+        messageRoot - et.Element, the root of the message structure XML Schema
+    RETURNS:
+        structure - dict, for each message structure/group name (less '.CONTENT') a tuple of
+            isChoice - boolean, True if the group is an xsd:choice rather than an xsd:sequence
+            items - tuple, a (ref, isOptional, maxOccurs) tuple for each element in the group, maxOccurs is None if unbounded
+    '''
+    structure = {}
+    for complexType in messageRoot.iterfind('xsd:complexType', namespaces):
+        name = complexType.attrib['name']
+        if not name.endswith('.CONTENT'):
+            continue
+        isChoice = False
+        sequenceList = complexType.find('xsd:sequence', namespaces)
+        if sequenceList is None:
+            sequenceList = complexType.find('xsd:choice', namespaces)
+            isChoice = True
+            if sequenceList is None:
+                continue
+        items = []
+        for element in sequenceList:
+            maxOccurs = element.attrib.get('maxOccurs', '1')
+            if maxOccurs == 'unbounded':
+                maxOccurs = None
+            else:
+                maxOccurs = int(maxOccurs)
+            items.append((element.attrib['ref'], element.attrib.get('minOccurs', '1') == '0', maxOccurs))
+        structure[name[:-8]] = (isChoice, tuple(items))
+    return structure
+
+
+@functools.lru_cache(maxsize=None)
+def getMessageStructure(schemaDir, msgStruct):
+    '''
+    Read in and compile the message structure XML Schema for this message structure
+    The compiled message structure is cached, so each message structure is only read once when converting a folder of messages
+    PARAMETERS:
+        schemaDir - str, the folder containing the HL7 v2.xml XML Schema files
+        msgStruct - str, the name of the message structure
+    RETURNS:
+        structure - dict, the compiled message structure (see compileStructure())
+    '''
+    if not os.path.isfile(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd')):
+        logging.critical('Unknown message structure (%s)', msgStruct)
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    messageTree = et.parse(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd'), xsdParser)
+    structure = compileStructure(messageTree.getroot())
+    if (msgStruct not in structure) or structure[msgStruct][0]:
+        logging.critical('XML Schema definition missing xsd:sequence for %s', msgStruct + '.CONTENT')
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
 
-    global segmentNo
-
-    if depth > 200:
-        # Treat this segment as unexpected
-        comment = et.Comment(Segments[segmentNo])
-        newElement = et.Element(tag)
-        newElement.append(comment)
-        segmentNo += 1
-        return newElement
-    depth += 1
-    sequenceAt = 0
-    thisElement = None
-    tagged = False
-    occurs = 0
-    lastSeg = None
-    while sequenceAt < len(sequenceList):
-        if sequenceList[sequenceAt].attrib['ref'] != Segments[segmentNo][0:3]:
-            # Check if this segment is here, after some optional segments
-            if len(sequenceList[sequenceAt].attrib['ref']) > 3:     # A group
-                groupRef = sequenceList[sequenceAt].attrib['ref']
-                groupOptional = False
-                if sequenceList[sequenceAt].attrib['minOccurs'] == '0':
-                    groupOptional = True
-                thisChoice = False
-                groupList = messageRoot.find("xsd:complexType[@name='" + groupRef + ".CONTENT']/xsd:sequence", namespaces)
-                if groupList is None:
-                    groupList = messageRoot.find("xsd:complexType[@name='" + groupRef + ".CONTENT']/xsd:choice", namespaces)
-                    thisChoice = True
-                    if groupList is None:
-                        logging.critical('XML Schema definition missing either xsd:sequence or xsd:choice for %s', groupRef + '.CONTENT')
+    # Check that the definintion starts with MSH
+    if structure[msgStruct][1][0][0] != 'MSH' :
+        logging.critical('MSH not defined for messages structure(%s)', msgStruct)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+    return structure
+
+
+def createXML(structure, msgStruct, segmentNo):
+    '''
+    Output an XML structure for the message structure, matching the segments in the Segments against the segments and groups in the structure.
+    PARAMETERS:
+        structure - dict, the compiled message structure (see compileStructure())
+        msgStruct - str, the name of the message structure
+        segmentNo - int, the first segment in Segments to be matched against the message structure
+    RETURNS:
+        thisElement - et.Element, the message structure element, or None if nothing matched
+        segmentNo - int, the next segment in Segments after the segments that were converted
+    Nested groups are handled with an explicit stack of group frames, rather than by recursion.
+    Each frame holds the group's items, tag, whether the group is optional, whether it is a choice, its depth,
+    how far we are through the items, the group element (if any) and how many times the last segment has occurred.
+    The depth is used to prevent indifinite nesting
+    '''
+
+    isChoice, items = structure[msgStruct]
+    stack = [{'items':items, 'tag':msgStruct, 'optional':False, 'isChoice':isChoice, 'depth':1, 'at':0, 'element':None, 'occurs':0, 'lastSeg':None}]
+    groupXML = None
+    resuming = False
+    while True:
+        frame = stack[-1]
+        items = frame['items']
+        finished = False
+        descend = False
+        if resuming:        # We have just finished with a group within this group
+            resuming = False
+            if groupXML is not None:        # At least one segment was found at in this group
+                if frame['element'] is None:
+                    frame['element'] = et.Element(frame['tag'])
+                frame['element'].append(groupXML)
+                if segmentNo >= len(Segments):
+                    finished = True
+            elif items[frame['at']][1]:     # Nothing found - make sure group is optional and skip if it is
+                frame['at'] += 1
+            else:
+                finished = True
+        while (not finished) and (frame['at'] < len(items)):
+            ref, isOptional, maxOccurs = items[frame['at']]
+            seg, Fields = segmentFields[segmentNo]
+            if ref != seg:
+                # Check if this segment is here, after some optional segments
+                if len(ref) > 3:     # A group
+                    if ref not in structure:
+                        logging.critical('XML Schema definition missing either xsd:sequence or xsd:choice for %s', ref + '.CONTENT')
                         logging.shutdown()
                         sys.exit(EX_CONFIG)
-                groupXML = createXML(groupList, groupRef, groupOptional, thisChoice, depth)
-                if groupXML is not None:        # At least one segment was found at in this group
-                    if not tagged:
-                        thisElement = et.Element(tag)
-                        tagged = True
-                    thisElement.append(groupXML)
-                    if segmentNo < len(Segments):       # More to do
-                        continue
-                    return thisElement
-                # Nothing found - make sure group is optional and skip if it is
-                if sequenceList[sequenceAt].attrib['minOccurs'] == '0':
-                    sequenceAt += 1
+                    if frame['depth'] > 200:
+                        # Treat this segment as unexpected
+                        groupXML = et.Element(ref)
+                        groupXML.append(et.Comment(Segments[segmentNo]))
+                        segmentNo += 1
+                        resuming = True
+                        break
+                    groupChoice, groupItems = structure[ref]
+                    stack.append({'items':groupItems, 'tag':ref, 'optional':isOptional, 'isChoice':groupChoice, 'depth':frame['depth'] + 1, 'at':0, 'element':None, 'occurs':0, 'lastSeg':None})
+                    descend = True
+                    break
+                # Check if this segment is optional
+                if isOptional:
+                    frame['at'] += 1
                     continue
-                return thisElement
-            # Check if this segment is optional
-            if sequenceList[sequenceAt].attrib['minOccurs'] == '0':
-                sequenceAt += 1
-                continue
-            # This is some sort of failure something, that is this segment isrequire and is not present
-            # If this sequence is optional, then return what we have
-            if optional:
-                return thisElement
-            # Otherwise, reat this segment as 'unexpected'
-            comment = et.Comment('Unexpected segment: ' + Segments[segmentNo])
-            if not tagged:
-                thisElement = et.Element(tag)
-                tagged = True
-            thisElement.append(comment)
+                # This is some sort of failure something, that is this segment isrequire and is not present
+                # If this sequence is optional, then return what we have
+                if frame['optional']:
+                    finished = True
+                    break
+                # Otherwise, reat this segment as 'unexpected'
+                comment = et.Comment('Unexpected segment: ' + Segments[segmentNo])
+                if frame['element'] is None:
+                    frame['element'] = et.Element(frame['tag'])
+                frame['element'].append(comment)
+                segmentNo += 1
+                if segmentNo < len(Segments):
+                    continue
+                finished = True
+                break
+            # A matching segment
+            if (frame['lastSeg'] is None) or (frame['lastSeg'] != seg):
+                frame['lastSeg'] = seg
+                frame['occurs'] = 0
+            if frame['element'] is None:
+                frame['element'] = et.Element(frame['tag'])
+            frame['element'].append(createSegment(seg, Fields))
             segmentNo += 1
-            if segmentNo < len(Segments):
+            if segmentNo == len(Segments):
+                finished = True
+                break
+            if frame['isChoice']:
+                finished = True
+                break
+            frame['occurs'] += 1
+            if maxOccurs is None:
                 continue
-            return thisElement
-        # A matching segment
-        seg = Segments[segmentNo][0:3]
-        if (lastSeg is None) or (lastSeg != seg):
-            lastSeg = seg
-            occurs = 0
-        if not tagged:
-            thisElement = et.Element(tag)
-            tagged = True
-        segElement = et.Element(seg)
-        Fields = Segments[segmentNo].split(fieldSep)
-        if Fields[0] == 'MSH':
-            Fields.insert(1, fieldSep)
-        seg = Fields[0]
-        Fields = Fields[1:]
-        xmlSeg = segmentRoot.find("xsd:complexType[@name='" + seg + ".CONTENT']/xsd:sequence", namespaces)
-        for i, field in enumerate(Fields):
-            if field == '':
+            if frame['occurs'] < maxOccurs:
                 continue
-            if (seg != 'MSH') and (i != 1):
-                fieldReps = field.split(repSep)
-            else:
-                fieldReps = [field]
-            for thisField in fieldReps:
-                if (i < len(xmlSeg)) and ('ref' in xmlSeg[i].attrib):
-                    fieldRef = xmlSeg[i].attrib['ref']
-                    fieldXML = et.Element(fieldRef)
-                    fieldType = fieldRoot.find("xsd:attributeGroup[@name='" + fieldRef + ".ATTRIBUTES']/xsd:attribute[@name='Type']", namespaces).attrib['fixed']
-                    if fieldType == 'varies':
-                        if (seg == 'OBX') and (fieldRef == 'OBX.5'):
-                            fieldType = Fields[1]
-                        elif (seg == 'MFE') and (fieldRef == 'MFE.4') and (len(Fields) > 4):
-                            fieldType = Fields[4]
-                    dataTypeBits = dataTypeRoot.find("xsd:complexType[@name='" + fieldType + "']/xsd:sequence", namespaces)
-                    if fieldType == 'FT':       # FT has a sequence, but not components
-                        dataTypeBits = None
-                    if dataTypeBits is not None:
-                        Components = thisField.split(compSep)
-                        for j, component in enumerate(Components):
-                            if component == '':
-                                continue
-                            componentRef = dataTypeBits[j].attrib['ref']
-                            componentType = dataTypeRoot.find("xsd:attributeGroup[@name='" + componentRef + ".ATTRIBUTES']/xsd:attribute[@name='Type']", namespaces).attrib['fixed']
-                            componentBits = dataTypeRoot.find("xsd:complexType[@name='" + componentType + "']/xsd:sequence", namespaces)
-                            if (componentBits is not None) and (subCompSep != ''):
-                                componentXML = et.Element(componentRef)
-                                subComponents = component.split(subCompSep)
-                                for k, subComponent in enumerate(subComponents):
-                                    if subComponent == '':
-                                        continue
-                                    subCompRef = componentBits[k].attrib['ref']
-                                    subCompType = dataTypeRoot.find("xsd:attributeGroup[@name='" + subCompRef + ".ATTRIBUTES']/xsd:attribute[@name='Type']", namespaces).attrib['fixed']
-                                    subComponentXML = et.Element(subCompRef)
-                                    subComponentXML.text = subComponent
-                                    fixElement(subComponentXML, subCompType)
-                                    componentXML.append(subComponentXML)
-                                fieldXML.append(componentXML)
-                            else:
-                                componentXML = et.Element(componentRef)
-                                componentXML.text = component
-                                fixElement(componentXML, componentType)
-                                fieldXML.append(componentXML)
-                    else:
-                        fieldXML.text = thisField
-                        fixElement(fieldXML, fieldType)
-                    segElement.append(fieldXML)
-                else:       # Undefined field
-                    fieldCode = f'{seg}.{i + 1:d}'
-                    fieldXML = et.Element(fieldCode)
-                    fieldXML.text = thisField
-                    segElement.append(fieldXML)
-        thisElement.append(segElement)
-        segmentNo += 1
-        if segmentNo == len(Segments):
-            return thisElement
-        if isChoice:
-            return thisElement
-        occurs += 1
-        maxOccurs = sequenceList[sequenceAt].attrib['maxOccurs']
-        if maxOccurs == 'unbounded':
-            continue
-        if int(occurs) < int(maxOccurs):
+            frame['at'] += 1
+        if descend or resuming:
             continue
-        sequenceAt += 1
-        if sequenceAt < len(sequenceList):
+        # This group is finished - return what we have to the enclosing group
+        stack.pop()
+        groupXML = frame['element']
+        if len(stack) == 0:
+            return groupXML, segmentNo
+        resuming = True
+
+
+def createSegment(seg, Fields):
+    '''
+    Output the XML for one segment
+    PARAMETERS:
+        seg - str, the segment name
+        Fields - list, the segment name followed by the fields of the segment
+    RETURNS:
+        segElement - et.Element, the segment element
+    '''
+    segElement = et.Element(seg)
+    seg = Fields[0]
+    fieldInfo = segmentFieldTypes.get(seg)
+    if seg == 'MSH':
+        # MSH.1 is the field separator and MSH.2 is the encoding characters, so neither can be split into repeats
+        for i, field in enumerate(Fields[1:3]):
+            if field != '':
+                et.SubElement(segElement, f'MSH.{i + 1:d}').text = field
+        start = 3
+    else:
+        start = 1
+    for i, field in enumerate(Fields[start:], start=start - 1):
+        if field == '':
             continue
-    return thisElement
+        for thisField in field.split(repSep):
+            if (i < len(fieldInfo)) and (fieldInfo[i] is not None):
+                fieldRef, fieldType = fieldInfo[i]
+                fieldXML = et.SubElement(segElement, fieldRef)
+                if fieldType == 'varies':
+                    if (seg == 'OBX') and (fieldRef == 'OBX.5'):
+                        fieldType = Fields[2]
+                    elif (seg == 'MFE') and (fieldRef == 'MFE.4') and (len(Fields) > 5):
+                        fieldType = Fields[5]
+                dataTypeBits = dataTypeComponents.get(fieldType)
+                if fieldType == 'FT':       # FT has a sequence, but not components
+                    dataTypeBits = None
+                if dataTypeBits is not None:
+                    Components = thisField.split(compSep)
+                    for j, component in enumerate(Components):
+                        if component == '':
+                            continue
+                        componentRef, componentType, componentBits = dataTypeBits[j]
+                        if (componentBits is not None) and (subCompSep != ''):
+                            componentXML = et.SubElement(fieldXML, componentRef)
+                            subComponents = component.split(subCompSep)
+                            for k, subComponent in enumerate(subComponents):
+                                if subComponent == '':
+                                    continue
+                                subCompRef, subCompType = componentBits[k]
+                                subComponentXML = et.SubElement(componentXML, subCompRef)
+                                subComponentXML.text = subComponent
+                                fixElement(subComponentXML, subCompType)
+                        else:
+                            componentXML = et.SubElement(fieldXML, componentRef)
+                            componentXML.text = component
+                            fixElement(componentXML, componentType)
+                else:
+                    fieldXML.text = thisField
+                    fixElement(fieldXML, fieldType)
+            else:       # Undefined field
+                fieldCode = f'{seg}.{i + 1:d}'
+                fieldXML = et.SubElement(segElement, fieldCode)
+                fieldXML.text = thisField
+    return segElement
+
+
+def addEscapes(thisElement, lastChild, text):
+    '''
+    Add text to thisElement, after lastChild, turning any escape sequences into child <escape ... /> elements
+    The text up to the first child is the text of thisElement and the text after each child is the tail of that child
+    PARAMETERS:
+        thisElement - Element, the element the text belongs to
+        lastChild - Element, the last child of thisElement, or None if it has no children yet
+        text - str, the text to add
+    RETURNS:
+        lastChild - Element, the last child of thisElement, or None if it still has no children
+    '''
+    textAt = 0
+    for escape in xmlEscape.finditer(text):
+        if lastChild is None:
+            thisElement.text = text[textAt:escape.start()]
+        else:
+            lastChild.tail = text[textAt:escape.start()]
+        lastChild = et.SubElement(thisElement, 'escape', V=escape.group(1))
+        textAt = escape.end()
+    if lastChild is None:
+        thisElement.text = text[textAt:]
+    else:
+        lastChild.tail = text[textAt:]
+    return lastChild
 
 
 def fixElement(thisElement, textType):
@@ -291,56 +417,228 @@ def fixElement(thisElement, textType):
     We may need to add child element like <escape ... />
     The tail of thisElement will be the text up to the <escape ... />
     and the remaining text will be the tail of the child <escape ... /> tag
+    Each byte of a \\Xdddd\\ or \\Zdddd\\ escape sequence becomes a character reference (&#xdd;), as the bytes
+    may not be characters that XML can hold (control characters, ISO 2022 escapes) and xml2bar.py turns them back into \\Xdd\\
     '''
-    if textType not in ['TX', 'FT', 'CF']:
+    if textType not in escapeTypes:
         return
     elementText = thisElement.text
-    while (charRef := charXref.search(elementText)) is not None:
-        chars = charRef.group()[2:-1]
-        repChars = ''
-        for cp in range(0, len(chars), 2):
-            repChars += r'&#x' + chars[cp:cp + 2] + ';'
-        elementText = elementText[0:charRef.start()] + repChars + elementText[charRef.end():]
-    while (charRef := charZref.search(elementText)) is not None:
-        chars = charRef.group()[2:-1]
-        repChars = ''
-        for cp in range(0, len(chars), 2):
-            repChars += r'&#x' + chars[cp:cp + 2] + ';'
-        elementText = elementText[0:charRef.start()] + repChars + elementText[charRef.end():]
-    thisElement.text = elementText
-    firstEscape = None
-    for replacement in xmlReplacements:
-        if (found := replacement.search(elementText)) is not None:
-            if (firstEscape is None) or (found.start() < firstEscape):
-                firstEscape = found.start()
-                firstEnd = found.end()
-                firstGroup = found.group()
-    if firstEscape is None:
+    if (elementText is None) or ('\\' not in elementText):        # No escape sequences, so nothing to fix
         return
-    thisElement.text = elementText[:firstEscape]
-    escapeElement = et.Element('escape')
-    escapeElement.attrib['V'] = firstGroup[1:-1]
-    escapeElement.tail = elementText[firstEnd:]
-    thisElement.append(escapeElement)
-    lastEscapeElement = escapeElement
-    escapeElementTail = escapeElement.tail
-    while True:
-        nextEscape = None
-        for replacement in xmlReplacements:
-            if (found := replacement.search(escapeElementTail)) is not None:
-                if (nextEscape is None) or (found.start() < nextEscape):
-                    nextEscape = found.start()
-                    nextEnd = found.end()
-                    nextGroup = found.group()
-        if nextEscape is None:
-            return
-        lastEscapeElement.tail = escapeElementTail[:nextEscape]
-        escapeElement = et.Element('escape')
-        escapeElement.attrib['V'] = nextGroup[1:-1]
-        escapeElement.tail = escapeElementTail[nextEnd:]
-        thisElement.append(escapeElement)
-        lastEscapeElement = escapeElement
-        escapeElementTail = escapeElement.tail
+    lastChild = None
+    textAt = 0
+    for charMatch in charRef.finditer(elementText):
+        lastChild = addEscapes(thisElement, lastChild, elementText[textAt:charMatch.start()])
+        chars = charMatch.group(1)
+        for cp in range(0, len(chars), 2):
+            lastChild = et.Entity('#x' + chars[cp:cp + 2])
+            thisElement.append(lastChild)
+        textAt = charMatch.end()
+    addEscapes(thisElement, lastChild, elementText[textAt:])
+
+
+@functools.lru_cache(maxsize=None)
+def loadSchemas(schemaDir):
+    '''
+    Read in the segment, field and data type XML Schemas and the table of message structures (hl7Table0354.csv)
+    The schemas are only read once in each process, so each worker process reads them the first time it converts a message
+    PARAMETERS:
+        schemaDir - str, the folder containing the HL7 v2.xml XML Schema files
+    '''
+
+    global segmentFieldTypes, dataTypeComponents, hl7messageStructures
+
+    # Check that the schemaDir folder exist and read in the segment, fields and datatype schema
+    if not os.path.isdir(schemaDir):
+        logging.critical('No schemaDir folder named "%s"', schemaDir)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+    if not os.path.isdir(os.path.join(schemaDir, 'xsd')):
+        logging.critical('No schemaDir folder named "%s/xsd"', schemaDir)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+    if not os.path.isfile(os.path.join(schemaDir, 'xsd', 'segments.xsd')):
+        logging.critical('No file "segments.xsd" in schemaDir folder(%s/xsd)', schemaDir)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+    if not os.path.isfile(os.path.join(schemaDir, 'xsd', 'fields.xsd')):
+        logging.critical('No file "fields.xsd" in schemaDir folder(%s/xsd)', schemaDir)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+    if not os.path.isfile(os.path.join(schemaDir, 'xsd', 'datatypes.xsd')):
+        logging.critical('No file "datatypes.xsd" in schemaDir folder(%s/xsd)', schemaDir)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+
+    # Index the segment, field and data type definitions so that they don't have to be searched for every segment
+    segmentSequences = readSchema(os.path.join(schemaDir, 'xsd', 'segments.xsd'), '.CONTENT')[0]
+    fieldTypes = readSchema(os.path.join(schemaDir, 'xsd', 'fields.xsd'), '')[1]
+    # Pair each field with its data type, so that converting a field only needs one lookup
+    segmentFieldTypes = {}
+    for seg, fieldRefs in segmentSequences.items():
+        segmentFieldTypes[seg] = tuple([(fieldRef, fieldTypes.get(fieldRef)) if fieldRef is not None else None for fieldRef in fieldRefs])
+    dataTypeSequences, componentTypes = readSchema(os.path.join(schemaDir, 'xsd', 'datatypes.xsd'), '')
+    # Resolve the data type of every component, and the subcomponents of every component, so that converting a component only needs one lookup
+    subComponentTypes = {}
+    for dataType, componentRefs in dataTypeSequences.items():
+        subComponentTypes[dataType] = tuple([(componentRef, componentTypes.get(componentRef)) for componentRef in componentRefs])
+    dataTypeComponents = {}
+    for dataType, subComponents in subComponentTypes.items():
+        dataTypeComponents[dataType] = tuple([(componentRef, componentType, subComponentTypes.get(componentType)) for componentRef, componentType in subComponents])
+
+    # Check that the message structure file exists
+    if not os.path.isfile(os.path.join(schemaDir, 'hl7Table0354.csv')):
+        logging.critical('No file "hl7Table054.csv" in schemaDir folder(%s/xsd)', schemaDir)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+    hl7messageStructures = {}
+    with open(os.path.join(schemaDir, 'hl7Table0354.csv'), 'rt', encoding='utf-8') as hl7TableFile:
+        csvReader = csv.reader(hl7TableFile, delimiter='\t')
+        next(csvReader, None)       # Skip the header row
+        for row in csvReader:
+            msgStructure = row[0]
+            msgTypeStructures = hl7messageStructures.setdefault(msgStructure[0:3], {})
+            msgTriggers = row[1].split(',')
+            for trigger in msgTriggers:
+                thisTrigger = trigger.strip()
+                if len(thisTrigger) == 3:
+                    msgTypeStructures[thisTrigger] = msgStructure
+                elif (len(thisTrigger) == 7) and (thisTrigger[3:4] == '-'):
+                    thisLetter = thisTrigger[0:1]
+                    thisStart = int(thisTrigger[1:3])
+                    thisEnd = int(thisTrigger[5:7]) + 1
+                    for eachTrigger in range(thisStart, thisEnd):
+                        oneTrigger = f'{thisLetter}{eachTrigger:02d}'
+                        msgTypeStructures[oneTrigger] = msgStructure
+
+
+def processMessage(messageFile, schemaDir, outputDir):
+    '''
+    Convert one HL7 v2.x vertical bar encoded message into an HL7 v2.xml XML tagged message
+    PARAMETERS:
+        messageFile - str, the file containing the HL7 v2.x vertical bar encoded message, or '-' for standard input
+        schemaDir - str, the folder containing the HL7 v2.xml XML Schema files
+        outputDir - str, the folder where the HL7 v2.xml XML tagged message will be created
+    '''
+
+    global Segments, segmentFields, fieldSep, repSep, compSep, subCompSep
+
+    loadSchemas(schemaDir)
+    hl7Message = getDocument(messageFile)
+
+    # Check for MLLP
+    if (hl7Message[0:1] == chr(11)) and (hl7Message[-2:] == chr(28) + chr(13)):
+        hl7Message = hl7Message[1:-2]
+
+    # Convert this hl7 v2.x vertical bar encoded message
+    Segments = hl7Message.rstrip().split('\r')
+
+    # Check that the MSH can at least be partially parsed
+    MSH = Segments[0]
+    if len(MSH) < 20:
+        logging.fatal('First segment too short - less than 20 characters')
+        sys.exit(EX_DATAERR)
+    if MSH[0:3] != 'MSH':
+        logging.fatal('First segment not MSH')
+        sys.exit(EX_DATAERR)
+
+    # Now partially parse the first segment (should be MSH)
+    # for the field separator and encoding characters
+    fieldSep = MSH[3:4]
+    MSHfields = MSH.split(fieldSep)
+    if len(MSHfields[1]) < 4:
+        subCompSep = ''
+    else:
+        subCompSep = MSHfields[1][3:4]
+    if len(MSHfields[1]) < 2:
+        logging.fatal('MSH.2 field less then 2 characters long')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    compSep = MSHfields[1][0:1]
+    repSep = MSHfields[1][1:2]
+
+    # And check that MSH has enough fields
+    if len(MSHfields) < 12:
+        logging.fatal('MSH segment too short - no version!')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+
+    # Now we can further parse the MSH segment for the message type, event and structure
+    # All we really want is structure (msgStruct)
+    struct = MSHfields[8]
+    msgStruct = ''
+    if struct == '' :
+        logging.fatal('Missing MSH.9.1 component [Message Code]')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    if struct == 'ACK':         # |ACK| is legal?
+        msgStruct = 'ACK'
+    else:
+        typeParts = struct.split(compSep)
+        if len(typeParts) == 1:     # |TYP| is illegal if TYP is not ACK
+            logging.critical('Missing MSH.9.2 component [Trigger Event] and MSH.9.3 component [Message Structure]')
+            logging.shutdown()
+            sys.exit(EX_DATAERR)
+        msgType = typeParts[0]
+        msgTrigger = typeParts[1]
+        if len(typeParts) == 3:
+            msgStruct = typeParts[2]
+        if msgStruct == '':           # We don't have structure, so we will have to deduce it
+            if msgType == '':           # |^TRG| and |^TRG^| are illegal
+                logging.critical('Missing MSH.9.1 component [Message Type]')
+                logging.shutdown()
+                sys.exit(EX_DATAERR)
+            if msgTrigger == '':
+                if msgType == 'ACK':        # |ACK^| and |ACK^^| are legal?
+                    msgStruct = 'ACK'
+                else:               # |TYP^| and |TYP^^| are illegal
+                    logging.critical('Missing MSH.9.2 component [Trigger Event] and MSH.9.3 component [Message Structure]')
+                    logging.shutdown()
+                    sys.exit(EX_DATAERR)
+            else:       # Try and deduce message structure from type and trigger
+                if msgType not in hl7messageStructures:
+                    logging.critical('Unknown MSH.9.1 [Message Type] (%s)', msgType)
+                    logging.shutdown()
+                    sys.exit(EX_DATAERR)
+                if msgTrigger not in hl7messageStructures[msgType]:
+                    logging.critical('Unknown MSH.9.2 [Message Trigger] (%s)', msgTrigger)
+                    logging.shutdown()
+                    sys.exit(EX_DATAERR)
+                msgStruct = hl7messageStructures[msgType][msgTrigger]
+
+    # Now we need the message structure as defined in the xsd
+    structure = getMessageStructure(schemaDir, msgStruct)
+
+    # Split every segment into fields now, rather than each time a segment is matched against the message structure
+    segmentFields = []
+    for segment in Segments:
+        Fields = segment.split(fieldSep)
+        if Fields[0] == 'MSH':
+            Fields.insert(1, fieldSep)
+        segmentFields.append((segment[0:3], Fields))
+
+    # Now create the HL7 v2.xml data
+    # lxml won't accept 'xmlns' attributes, so the namespaces have to be declared when the root element is created
+    hl7XML = et.Element(msgStruct, nsmap={None:'urn:hl7-org:v2xml', 'xsi':'http://www.w3.org/2001/XMLSchema-instance'})
+    hl7XML.set('{http://www.w3.org/2001/XMLSchema-instance}schemaLocation', 'urn:hl7-org:v2xml ' + msgStruct + '.xsd')
+    messageXML, segmentNo = createXML(structure, msgStruct, 0)
+    hl7XML.extend(list(messageXML))
+
+    # Save the HL7 V2.xml message
+    # lxml's serializer writes the encoded XML straight to the file (or the standard output buffer)
+    if messageFile == '-':
+        sys.stdout.buffer.write(et.tostring(hl7XML, encoding='utf-8', xml_declaration=False, pretty_print=True))
+    else:
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info(et.tostring(hl7XML, encoding='unicode', pretty_print=True))
+        basename = os.path.basename(messageFile)
+        name, ext = os.path.splitext(basename)
+        outputFile = name + '.xml'
+        if outputDir is not None:
+            outputFile = os.path.join(outputDir, outputFile)
+        elif outputFile == messageFile:
+            outputFile = 'XML_' + outputFile
+        et.ElementTree(hl7XML).write(outputFile, encoding='utf-8', xml_declaration=False, pretty_print=True)
 
 
 if __name__ == '__main__':
@@ -398,64 +696,8 @@ if __name__ == '__main__':
             logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p')
     logging.debug('Logging set up')
 
-    # Check that the schemaDir folder exist and read in the segment, fields and datatype schema
-    if not os.path.isdir(schemaDir):
-        logging.critical('No schemaDir folder named "%s"', schemaDir)
-        logging.shutdown()
-        sys.exit(EX_CONFIG)
-    if not os.path.isdir(os.path.join(schemaDir, 'xsd')):
-        logging.critical('No schemaDir folder named "%s/xsd"', schemaDir)
-        logging.shutdown()
-        sys.exit(EX_CONFIG)
-    if not os.path.isfile(os.path.join(schemaDir, 'xsd', 'segments.xsd')):
-        logging.critical('No file "segments.xsd" in schemaDir folder(%s/xsd)', schemaDir)
-        logging.shutdown()
-        sys.exit(EX_CONFIG)
-    segmentTree = et.parse(os.path.join(schemaDir, 'xsd', 'segments.xsd'))
-    segmentRoot = segmentTree.getroot()
-    if not os.path.isfile(os.path.join(schemaDir, 'xsd', 'fields.xsd')):
-        logging.critical('No file "fields.xsd" in schemaDir folder(%s/xsd)', schemaDir)
-        logging.shutdown()
-        sys.exit(EX_CONFIG)
-    fieldTree = et.parse(os.path.join(schemaDir, 'xsd', 'fields.xsd'))
-    fieldRoot = fieldTree.getroot()
-    if not os.path.isfile(os.path.join(schemaDir, 'xsd', 'datatypes.xsd')):
-        logging.critical('No file "datatypes.xsd" in schemaDir folder(%s/xsd)', schemaDir)
-        logging.shutdown()
-        sys.exit(EX_CONFIG)
-    dataTypeTree = et.parse(os.path.join(schemaDir, 'xsd', 'datatypes.xsd'))
-    dataTypeRoot = dataTypeTree.getroot()
-    namespaces={'xsd':'http://www.w3.org/2001/XMLSchema'}
-
-    # Check that the message structure file exists
-    if not os.path.isfile(os.path.join(schemaDir, 'hl7Table0354.csv')):
-        logging.critical('No file "hl7Table054.csv" in schemaDir folder(%s/xsd)', schemaDir)
-        logging.shutdown()
-        sys.exit(EX_CONFIG)
-    hl7messageStructures = {}
-    with open(os.path.join(schemaDir, 'hl7Table0354.csv'), 'rt', encoding='utf-8') as hl7TableFile:
-        csvReader = csv.reader(hl7TableFile, delimiter='\t')
-        header = True
-        for row in csvReader:
-            if header:
-                header = False
-                continue
-            msgStructure = row[0]
-            msgStruct = msgStructure[0:3]
-            if msgStruct not in hl7messageStructures:
-                hl7messageStructures[msgStruct] = {}
-            msgTriggers = row[1].split(',')
-            for trigger in msgTriggers:
-                thisTrigger = trigger.strip()
-                if len(thisTrigger) == 3:
-                    hl7messageStructures[msgStruct][thisTrigger] = msgStructure
-                elif (len(thisTrigger) == 7) and (thisTrigger[3:4] == '-'):
-                    thisLetter = thisTrigger[0:1]
-                    thisStart = int(thisTrigger[1:3])
-                    thisEnd = int(thisTrigger[5:7]) + 1
-                    for eachTrigger in range(thisStart, thisEnd):
-                        oneTrigger = f'{thisLetter}{eachTrigger:02d}'
-                        hl7messageStructures[msgStruct][oneTrigger] = msgStructure
+    # Read in the segment, field and data type XML Schemas and the table of message structures
+    loadSchemas(schemaDir)
 
     # If inputFile is specified and is '-', then read one HL7 v2.x vertical bar encoded message from standard input
     # If inputFile is specified and is not '-', and inputDir is None then read one HL7 v2.x vertical bar encoded message from ./inputFile.
@@ -483,131 +725,9 @@ if __name__ == '__main__':
                 hl7MessageFiles.append(os.path.join(inputDir, thisFile))
 
     # Process each of these HL7 v2.x vertical bar encoded messages
-    for messageFile in hl7MessageFiles:
-        hl7Message = getDocument(messageFile)
-
-        # Check for MLLP
-        if (hl7Message[0:1] == chr(11)) and (hl7Message[-2:] == chr(28) + chr(13)):
-            hl7Message = hl7Message[1:-2]
-
-        # Convert this hl7 v2.x vertical bar encoded message
-        Segments = hl7Message.rstrip().split('\r')
-
-        # Check that the MSH can at least be partially parsed
-        MSH = Segments[0]
-        if len(MSH) < 20:
-            logging.fatal('First segment too short - less than 20 characters')
-            sys.exit(EX_DATAERR)
-        if MSH[0:3] != 'MSH':
-            logging.fatal('First segment not MSH')
-            sys.exit(EX_DATAERR)
-
-        # Now partially parse the first segment (should be MSH)
-        # for the field separator and encoding characters
-        fieldSep = MSH[3:4]
-        MSHfields = MSH.split(fieldSep)
-        if len(MSHfields[1]) < 4:
-            subCompSep = ''
-        else:
-            subCompSep = MSHfields[1][3:4]
-        if len(MSHfields[1]) < 3:
-            escChar = ''
-            subCompSep = ''
-        else:
-            escChar = MSHfields[1][2:3]
-            subCompSep = MSHfields[1][3:4]
-        if len(MSHfields[1]) < 2:
-            logging.fatal('MSH.2 field less then 2 characters long')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-        compSep = MSHfields[1][0:1]
-        repSep = MSHfields[1][1:2]
-
-        # And check that MSH has enough fields
-        if len(MSHfields) < 12:
-            logging.fatal('MSH segment too short - no version!')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-
-        # Now we can further parse the MSH segment for the message type, event and structure
-        # All we really want is structure (msgStruct)
-        struct = MSHfields[8]
-        msgStruct = ''
-        if struct == '' :
-            logging.fatal('Missing MSH.9.1 component [Message Code]')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-        if struct == 'ACK':         # |ACK| is legal?
-            msgStruct = 'ACK'
-        else:
-            typeParts = struct.split(compSep)
-            if len(typeParts) == 1:     # |TYP| is illegal if TYP is not ACK
-                logging.critical('Missing MSH.9.2 component [Trigger Event] and MSH.9.3 component [Message Structure]')
-                logging.shutdown()
-                sys.exit(EX_DATAERR)
-            msgType = typeParts[0]
-            msgTrigger = typeParts[1]
-            if len(typeParts) == 3:
-                msgStruct = typeParts[2]
-            if msgStruct == '':           # We don't have structure, so we will have to deduce it
-                if msgType == '':           # |^TRG| and |^TRG^| are illegal
-                    logging.critical('Missing MSH.9.1 component [Message Type]')
-                    logging.shutdown()
-                    sys.exit(EX_DATAERR)
-                if msgTrigger == '':
-                    if msgType == 'ACK':        # |ACK^| and |ACK^^| are legal?
-                        msgStruct = 'ACK'
-                    else:               # |TYP^| and |TYP^^| are illegal
-                        logging.critical('Missing MSH.9.2 component [Trigger Event] and MSH.9.3 component [Message Structure]')
-                        logging.shutdown()
-                        sys.exit(EX_DATAERR)
-                else:       # Try and deduce message structure from type and trigger
-                    if msgType not in hl7messageStructures:
-                        logging.critical('Unknown MSH.9.1 [Message Type] (%s)', msgType)
-                        logging.shutdown()
-                        sys.exit(EX_DATAERR)
-                    if msgTrigger not in hl7messageStructures[msgType]:
-                        logging.critical('Unknown MSH.9.2 [Message Trigger] (%s)', msgTrigger)
-                        logging.shutdown()
-                        sys.exit(EX_DATAERR)
-                    msgStruct = hl7messageStructures[msgType][msgTrigger]
-
-        # Now we need to read in the message structure as defined in the xsd
-        if not os.path.isfile(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd')):
-            logging.critical('Unknown message structure (%s)', msgStruct)
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-        messageTree = et.parse(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd'))
-        messageRoot = messageTree.getroot()
-        segmentList = messageRoot.find("xsd:complexType[@name='" + msgStruct + ".CONTENT']/xsd:sequence", namespaces)
-
-        # Check that the definintion starts with MSH
-        if segmentList[0].attrib['ref'] != 'MSH' :
-            logging.critical('MSH not defined for messages structure(%s)', msgStruct)
-            logging.shutdown()
-            sys.exit(EX_CONFIG)
-
-        # Now create the HL7 v2.xml data
-        segmentNo = 0
-        hl7XML = createXML(segmentList, msgStruct, False, False, 0)
-        hl7XML.attrib['xmlns'] = 'urn:hl7-org:v2xml'
-        hl7XML.attrib['xmlns:xsi'] = 'http://www.w3.org/2001/XMLSchema-instance'
-        hl7XML.attrib['xsi:schemaLocation'] = 'urn:hl7-org:v2xml ' + msgStruct + '.xsd'
-        et.indent(hl7XML, '    ')
-
-        # Save the HL7 V2.xml message
-        s = et.tostring(hl7XML, encoding='unicode')
-        s = hl7charRef.sub(r'&\1', s)
-        if messageFile == '-':
-            print(s)
-        else:
-            logging.info(s)
-            basename = os.path.basename(messageFile)
-            name, ext = os.path.splitext(basename)
-            outputFile = name + '.xml'
-            if outputDir is not None:
-                outputFile = os.path.join(outputDir, outputFile)
-            elif outputFile == messageFile:
-                outputFile = 'XML_' + outputFile
-            with open(outputFile, 'wt', encoding='utf-8', newline='') as fpout:
-                print(s, file=fpout)
+    # Every message is independent of every other message, so a folder of messages is converted by a pool of processes
+    if len(hl7MessageFiles) == 1:
+        processMessage(hl7MessageFiles[0], schemaDir, outputDir)
+    else:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            list(executor.map(processMessage, hl7MessageFiles, itertools.repeat(schemaDir), itertools.repeat(outputDir), chunksize=16))
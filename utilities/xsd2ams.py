@@ -51,7 +51,10 @@ import sys
 import logging
 import argparse
 import csv
-from xml.etree import ElementTree as et
+import functools
+import itertools
+import concurrent.futures
+from lxml import etree as et
 from openpyxl import Workbook
 
 # This next section is plagurised from /usr/include/sysexits.h
@@ -74,79 +77,206 @@ EX_PROTOCOL = 76        # remote error in protocol
 EX_NOPERM = 77          # permission denied
 EX_CONFIG = 78          # configuration error
 
-hl7messageTypes = {}    # The descriptions of the message types
-hl7segments = {}        # The description and chapter for each segment
 namespaces={'xsd':'http://www.w3.org/2001/XMLSchema'}   # The namespaces in the XSD message structure definition
-messageRoot = None      # The root of the XSD message structure definition
-lines = []              # The list of lines that make up this AMS
 
 
-def render(sequence, indent, isChoice):
+def eventDescription(event):
     '''
-    Render an XML sequence as an Abstract Message Structure
+    Strip the message types off the front of an HL7 Table 0003 event description
     PARAMETERS:
-        sequence, XML Element - an XML Schema sequence definition
+        event, str - the event description from HL7 Table 0003
     RETURNS:
-        lines, list - list of lines for of the AMS
+        event, str - the event description, less the message types
+    '''
+
+    head, sep, tail = event.partition('-')
+    if sep == '':
+        head, sep, tail = event.partition(' ')
+    if sep == '':
+        return event.strip()
+    return tail.strip()
+
+
+def indexContents(xsdFile):
+    '''
+    Index the xsd:sequence or xsd:choice of every complexType in an XML Schema message structure definition
+    The XML Schema is read with iterparse() and each complexType is discarded once it has been indexed,
+    so only the index, and not the whole XML Schema, is kept in memory
+    PARAMETERS:
+        xsdFile, str - the XML Schema message structure definition file
+    RETURNS:
+        contents, dict - for each complexType name, a tuple of the attributes of each element in the xsd:sequence or xsd:choice
+                         (None if there is neither) and True if it is an xsd:choice
     '''
 
-    firstSeg = True
-    for segNo, seg in enumerate(sequence):
-        name = seg.attrib['ref']
+    contents = {}
+    xsd = '{' + namespaces['xsd'] + '}'
+    for event, complexType in et.iterparse(xsdFile, events=('end',), tag=xsd + 'complexType',
+                                           remove_blank_text=True, remove_comments=True, remove_pis=True):
+        if complexType.getparent().getparent() is not None:      # Only top level definitions are wanted
+            continue
+        name = complexType.attrib.get('name')
+        if name is not None:
+            isChoice = False
+            sequence = complexType.find('xsd:sequence', namespaces)
+            if sequence is None:
+                isChoice = True
+                sequence = complexType.find('xsd:choice', namespaces)
+            if sequence is not None:
+                sequence = tuple([dict(element.attrib) for element in sequence])
+            contents[name] = (sequence, isChoice)
+        # Discard this definition, and any that came before it
+        complexType.clear()
+        while complexType.getprevious() is not None:
+            del complexType.getparent()[0]
+    return contents
+
+
+@functools.lru_cache(maxsize=4096)
+def formatSegment(name, isChoice, isFirst, isLast, isUnbounded, isOptional):
+    '''
+    Format a segment name with the Abstract Message Structure brackets
+    The same few segments are formatted the same way many times, so the formatted names are cached
+    PARAMETERS:
+        name, str - the segment name
+        isChoice, boolean - True if the segment is one of the segments in a choice
+        isFirst, boolean - True if the segment is the first segment in the choice
+        isLast, boolean - True if the segment is the last segment in the choice
+        isUnbounded, boolean - True if the segment can repeat
+        isOptional, boolean - True if the segment is optional
+    RETURNS:
+        name, str - the segment name, with '<', '|' and '>' for choices, '{}' if it can repeat and '[]' if it is optional
+    '''
+
+    if isChoice:
+        if isFirst:
+            name = '<' + name
+        else:
+            name = ' ' + name
+        if isLast:
+            name = name + '>'
+        else:
+            name = name + '|'
+    if isUnbounded:
+        name = '{' + name + '}'
+    if isOptional:
+        name = '[' + name + ']'
+    return name
+
+
+def render(sequence, isChoice, contents, segments, emit):
+    '''
+    Render an XML sequence as an Abstract Message Structure
+    Nested groups are rendered from an explicit stack of group frames, rather than by recursion.
+    Each frame holds the group's elements, the index of the last element, how far we are through the sequence, whether the group is a choice,
+    whether the first segment of the choice has been rendered, the depth of indenting, the indent string for that depth
+    and the lines that close the group.
+    PARAMETERS:
+        sequence, tuple - the attributes of each element in an XML Schema sequence definition
+        isChoice, boolean - True if sequence is an XML Schema choice definition
+        contents, dict - the indexed complexTypes of the XML Schema message structure definition (see indexContents())
+        segments, dict - the description and chapter for each segment
+        emit, function - called with each line of the AMS, as it is rendered
+    '''
+
+    stack = [{'sequence':sequence, 'last':len(sequence) - 1, 'at':0, 'isChoice':isChoice, 'firstSeg':True, 'depth':0, 'indent':'', 'close':[]}]
+    while len(stack) > 0:
+        frame = stack[-1]
+        sequence = frame['sequence']
+        segNo = frame['at']
+        if segNo > frame['last']:      # This group is finished - close it
+            stack.pop()
+            for line in frame['close']:
+                emit(line)
+            continue
+        frame['at'] += 1
+        attributes = sequence[segNo]
+        name = attributes['ref']
         if name.startswith('any'):
             continue
+        isOptional = (attributes['minOccurs'] == '0')
+        isUnbounded = (attributes['maxOccurs'] == 'unbounded')
+        indent = frame['indent']
         if len(name) == 3:      # A segment
-            if name in hl7segments:
-                segName, chapter = hl7segments[name]
-            else:
-                segName = 'Unknown'
-                chapter = ''
-            if isChoice:
-                if firstSeg:
-                    firstSeg = False
-                    name = '<' + name
-                    if segNo == (len(sequence) - 1):
-                        name = name + '>'
-                    else:
-                        name = name + '|'
-                elif segNo == (len(sequence) - 1):
-                    name = ' ' + name + '>'
-                else:
-                    name = ' ' + name + '|'
-            if seg.attrib['maxOccurs'] == 'unbounded':
-                name = '{' + name + '}'
-            if seg.attrib['minOccurs'] == '0':
-                name = '[' + name + ']'
-            lines.append([indent + name, segName, chapter])
-        else:
-            if seg.attrib['minOccurs'] == '0':
-                lines.append([indent + '[', name + ' - begin', ''])
-                indent += '   '
-                if seg.attrib['maxOccurs'] == 'unbounded':
-                    lines.append([indent + '{', '', ''])
-                    indent += '   '
-            elif seg.attrib['maxOccurs'] == 'unbounded':
-                lines.append([indent + '{', name + ' - begin', ''])
-                indent += '   '
-            thisChoice = False
-            newSequence = messageRoot.find("xsd:complexType[@name='" + name + ".CONTENT']/xsd:sequence", namespaces)
-            if newSequence is None:
-                thisChoice = True
-                newSequence = messageRoot.find("xsd:complexType[@name='" + name + ".CONTENT']/xsd:choice", namespaces)
-            # logging.debug('newSequence for name(%s) - %s, isChoice(%s)', name, repr(newSequence), isChoice)
-            render(newSequence, indent, thisChoice)
-            if seg.attrib['minOccurs'] == '0':
-                if seg.attrib['maxOccurs'] == 'unbounded':
-                    indent = indent[:-3]
-                    lines.append([indent + '}', '' ''])
-                indent = indent[:-3]
-                lines.append([indent + ']', name + ' - end', ''])
-            elif seg.attrib['maxOccurs'] == 'unbounded':
-                indent = indent[:-3]
-                lines.append([indent + '}', name + ' - end' ''])
+            segName, chapter = segments.get(name, ('Unknown', ''))
+            isFirst = frame['firstSeg']
+            if frame['isChoice']:
+                frame['firstSeg'] = False
+            emit([indent + formatSegment(name, frame['isChoice'], isFirst, segNo == frame['last'], isUnbounded, isOptional), segName, chapter])
+            continue
+        if len(stack) > 200:
+            logging.critical('Message structure nested too deeply at group (%s)', name)
+            logging.shutdown()
+            sys.exit(EX_CONFIG)
+        # A group - open it now and save the lines that will close it, once all of its segments have been rendered
+        depth = frame['depth']
+        close = []
+        if isOptional:
+            emit([indent + '[', name + ' - begin', ''])
+            depth += 1
+            if isUnbounded:
+                emit([indent + '   {', '', ''])
+                close.append([indent + '   }', '', ''])
+                depth += 1
+            close.append([indent + ']', name + ' - end', ''])
+        elif isUnbounded:
+            emit([indent + '{', name + ' - begin', ''])
+            depth += 1
+            close.append([indent + '}', name + ' - end', ''])
+        newSequence, thisChoice = contents.get(name + '.CONTENT', (None, True))
+        # logging.debug('newSequence for name(%s) - %s, isChoice(%s)', name, repr(newSequence), isChoice)
+        stack.append({'sequence':newSequence, 'last':len(newSequence) - 1, 'at':0, 'isChoice':thisChoice, 'firstSeg':True, 'depth':depth, 'indent':'   ' * depth, 'close':close})
     return
 
 
+def renderStructure(schemaDir, msgStruct, messageTypes, messageEvents, segments, emit):
+    '''
+    Read in an XML Schema message structure definition and render it as an Abstract Message Structure
+    PARAMETERS:
+        schemaDir, str - the folder containing the HL7 v2.xml XML Schema files
+        msgStruct, str - the name of the message structure
+        messageTypes, dict - the descriptions of the message types
+        messageEvents, dict - the descriptions of the trigger events
+        segments, dict - the description and chapter for each segment
+        emit, function - called with each line of the AMS, starting with the message structure name and description
+    '''
+
+    # Read in the message structure
+    contents = indexContents(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd'))
+    segmentList, isChoice = contents.get(msgStruct + '.CONTENT', (None, True))
+    if (segmentList is None) or isChoice:
+        logging.critical('XML Schema definition missing xsd:sequence for %s', msgStruct + '.CONTENT')
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+
+    # Check that the definintion starts with MSH
+    if segmentList[0]['ref'] != 'MSH' :
+        logging.critical('MSH not defined for messages structure(%s)', msgStruct)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+
+    # Now create the HL7 v2 Abstract Message Structure output
+    structName = messageTypes.get(msgStruct[0:3], 'Unknown') + ' - ' + messageEvents.get(msgStruct[-3:], 'Unknown')
+    if 'message' not in structName:
+        structName += ' message'
+    emit([msgStruct, structName, 'Chapter'])
+    render(segmentList, False, contents, segments, emit)
+    return
+
+
+def renderLines(schemaDir, msgStruct, messageTypes, messageEvents, segments):
+    '''
+    Render a message structure as a list of the lines of the Abstract Message Structure
+    PARAMETERS:
+        as for renderStructure(), less emit
+    RETURNS:
+        lines, list - list of lines for of the AMS
+    '''
+
+    lines = []
+    renderStructure(schemaDir, msgStruct, messageTypes, messageEvents, segments, lines.append)
+    return lines
+
 
 if __name__ == '__main__':
     '''
@@ -170,7 +300,7 @@ if __name__ == '__main__':
     parser.add_argument ('-L', '--logDir', dest='logDir', default='.', metavar='logDir',
                          help='The name of the directory where the logging file will be created')
     parser.add_argument ('-l', '--logFile', dest='logFile', metavar='logfile', help='The name of a logging file')
-    parser.add_argument('messageStructures', nargs='*',
+    parser.add_argument('messageStructures', nargs='+',
                         help='The basename of the HL7 v2.xml message structure file(s)')
 
     # Parse the command line
@@ -204,119 +334,79 @@ if __name__ == '__main__':
     logging.debug(msgStructures)
 
     # Check that the schemaDir folder exist
+    # Each folder is scanned once, rather than checking for each file separately
     if not os.path.isdir(schemaDir):
         logging.critical('No schemaDir folder named "%s"', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
-    if not os.path.isdir(os.path.join(schemaDir, 'xsd')):
+    with os.scandir(schemaDir) as entries:
+        schemaFiles = {entry.name:entry for entry in entries}
+    if ('xsd' not in schemaFiles) or not schemaFiles['xsd'].is_dir():
         logging.critical('No schemaDir folder named "%s/xsd"', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
+    with os.scandir(schemaFiles['xsd'].path) as entries:
+        xsdFiles = {entry.name for entry in entries if entry.is_file()}
 
     # Check that the message types and segments files exist
-    if not os.path.isfile(os.path.join(schemaDir, 'hl7messageTypes.csv')):
+    if ('hl7messageTypes.csv' not in schemaFiles) or not schemaFiles['hl7messageTypes.csv'].is_file():
         logging.critical('No file "hl7messageTypes.csv" in schemaDir folder(%s/xsd)', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
-    hl7messageTypes = {}
-    with open(os.path.join(schemaDir, 'hl7messageTypes.csv'), 'rt', encoding='utf-8') as hl7TableFile:
+    with open(schemaFiles['hl7messageTypes.csv'].path, 'rt', encoding='utf-8') as hl7TableFile:
         csvReader = csv.reader(hl7TableFile, delimiter='\t')
-        header = True
-        for row in csvReader:
-            if header:
-                header = False
-                continue
-            hl7messageTypes[row[0]] = row[1]
+        next(csvReader, None)       # Skip the header row
+        hl7messageTypes = {row[0]:row[1] for row in csvReader}
     logging.debug(hl7messageTypes)
-    if not os.path.isfile(os.path.join(schemaDir, 'hl7Table0003.csv')):
+    if ('hl7Table0003.csv' not in schemaFiles) or not schemaFiles['hl7Table0003.csv'].is_file():
         logging.critical('No file "hl7Table0003.csv" in schemaDir folder(%s/xsd)', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
-    hl7messageEvents = {}
-    with open(os.path.join(schemaDir, 'hl7Table0003.csv'), 'rt', encoding='utf-8') as hl7TableFile:
+    with open(schemaFiles['hl7Table0003.csv'].path, 'rt', encoding='utf-8') as hl7TableFile:
         csvReader = csv.reader(hl7TableFile, delimiter='\t')
-        header = True
-        for row in csvReader:
-            if header:
-                header = False
-                continue
-            event = row[1]
-            dashAt = event.find('-')
-            spaceAt = event.find(' ')
-            if dashAt is not None:
-                event = event[dashAt + 1:]
-            elif spaceAt is not None:
-                event = event[spaceAt + 1:]
-            event.strip()
-            hl7messageEvents[row[0]] = event
+        next(csvReader, None)       # Skip the header row
+        hl7messageEvents = {row[0]:eventDescription(row[1]) for row in csvReader}
     logging.debug(hl7messageEvents)
-    if not os.path.isfile(os.path.join(schemaDir, 'hl7segments.csv')):
+    if ('hl7segments.csv' not in schemaFiles) or not schemaFiles['hl7segments.csv'].is_file():
         logging.critical('No file "hl7segments.csv" in schemaDir folder(%s/xsd)', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
-    hl7segments = {}
-    with open(os.path.join(schemaDir, 'hl7segments.csv'), 'rt', encoding='utf-8') as hl7TableFile:
+    with open(schemaFiles['hl7segments.csv'].path, 'rt', encoding='utf-8') as hl7TableFile:
         csvReader = csv.reader(hl7TableFile, delimiter='\t')
-        header = True
-        for row in csvReader:
-            if header:
-                header = False
-                continue
-            hl7segments[row[0]] = (row[1], row[2])
+        next(csvReader, None)       # Skip the header row
+        hl7segments = {row[0]:(row[1], row[2]) for row in csvReader}
 
-    # Create the output Excel Workbook
-    if outputFile is None:
-        outputFile = msgStructures[0] + '.xlsx'
-    if outputDir is not None:
-        outputFile = os.path.join(outputDir, outputFile)
-    wb = Workbook()
-
-    # Process the message structures
-    firstMSGstructure = True
+    # Check that the message structure file(s) exist
     for msgStruct in msgStructures:
-        # Check that the message structure file(s) exists and read it in
-        if not os.path.isfile(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd')):
+        if msgStruct + '.xsd' not in xsdFiles:
             logging.critical('Unknown message structure (%s)', msgStruct)
             logging.shutdown()
             sys.exit(EX_DATAERR)
-        messageTree = et.parse(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd'))
-        messageRoot = messageTree.getroot()
-        segmentList = messageRoot.find("xsd:complexType[@name='" + msgStruct + ".CONTENT']/xsd:sequence", namespaces)
-        # logging.debug('message structure(%s), mesasgeRoot(%s), segmentList(%s)', msgStruct, messageRoot, repr(segmentList))
-
-        # Check that the definintion starts with MSH
-        if segmentList[0].attrib['ref'] != 'MSH' :
-            logging.critical('MSH not defined for messages structure(%s)', msgStruct)
-            logging.shutdown()
-            sys.exit(EX_CONFIG)
 
-        # Now create the HL7 v2 Abstract Message Structure output
-        lines = []
-        if msgStruct[0:3] in hl7messageTypes:
-            structName = hl7messageTypes[msgStruct[0:3]]
-        else:
-            structName = 'Unknown'
-        if msgStruct[-3:] in hl7messageEvents:
-            structName += ' -' + hl7messageEvents[msgStruct[-3:]]
-        else:
-            structName += ' - Unknown'
-        if structName.find('message') == -1:
-            structName += ' message'
-        lines.append([msgStruct, structName, 'Chapter'])
-        render(segmentList, '', False)
-        msgAMS = ''
-        for line in lines:
-            msgAMSline = '\t'.join(line)
-            msgAMS += msgAMSline + '\n'
-
-        # Save the HL7 V2 Abstract Message Structure
-        logging.info(msgAMS)
-        if firstMSGstructure:
-            ws = wb.active
-            ws.title = msgStruct
-            firstMSGstructure = False
+    # Create the output Excel Workbook
+    if outputFile is None:
+        outputFile = msgStructures[0] + '.xlsx'
+    if outputDir is not None:
+        outputFile = os.path.join(outputDir, outputFile)
+    wb = Workbook(write_only=True)
+
+    # Render the message structures and save them as HL7 V2 Abstract Message Structures
+    # A single message structure, that doesn't have to be logged, is rendered straight into its worksheet
+    # Otherwise each message structure is independent of every other message structure, so several are rendered by a pool of processes
+    if (len(msgStructures) == 1) and not logging.getLogger().isEnabledFor(logging.INFO):
+        ws = wb.create_sheet(msgStructures[0])
+        renderStructure(schemaDir, msgStructures[0], hl7messageTypes, hl7messageEvents, hl7segments, ws.append)
+    else:
+        if len(msgStructures) == 1:
+            msgAMSs = [renderLines(schemaDir, msgStructures[0], hl7messageTypes, hl7messageEvents, hl7segments)]
         else:
+            with concurrent.futures.ProcessPoolExecutor() as executor:
+                msgAMSs = list(executor.map(renderLines, itertools.repeat(schemaDir), msgStructures, itertools.repeat(hl7messageTypes),
+                                            itertools.repeat(hl7messageEvents), itertools.repeat(hl7segments)))
+        for msgStruct, lines in zip(msgStructures, msgAMSs):
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info(''.join(['\t'.join(line) + '\n' for line in lines]))
             ws = wb.create_sheet(msgStruct)
-        for line in lines:
-            ws.append(line)
+            for line in lines:
+                ws.append(line)
     wb.save(outputFile)
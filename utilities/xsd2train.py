@@ -1,7 +1,7 @@
 # pylint: disable=line-too-long
 '''
 Script xsd2train.py
-A script to render an HL7 v2.xml XML schema as a train diagram and output it to a '.png' file
+A script to render an HL7 v2.xml XML schema as a train diagram and output it to a '.png' (or '.svg' or '.pdf') file
 
 This script reads an HL7 v2.x message structure from the 'xsd' schema folder
 and then renders it as a train diagram (boxes for segment, arrows for optional and repeating)
@@ -10,17 +10,18 @@ and saves that as an image file.
 
     SYNOPSIS
     $ python bar2xml.py
-        [-m messageStructure|--messageStructure=messageStructure]
+        [-m messageStructure ...|--messageStructure=messageStructure ...]
         [-S schemaDir|--schemaDir=schemaDir]
         [-O outputDir|--outputDir=outputDir]
+        [-f outputFormat|--format=outputFormat]
         [-v loggingLevel|--verbose=logingLevel]
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
 
 
     REQUIRED
-    -m messageStructure|--messageStructure=messageStructure
-    The name of the HL7 v2.xml message structure definition file to be rendered.
+    -m messageStructure ...|--messageStructure=messageStructure ...
+    The name(s) of the HL7 v2.xml message structure definition file(s) to be rendered.
 
     OPTIONS
     -S schemaDir|--schemaDir=schemaDir
@@ -28,7 +29,11 @@ and saves that as an image file.
     (default = 'schema/v2.4')
 
     -O outputDir|--outputDir=outputDir
-    The folder where the rendered '.png' file will be saved (messageStructure.png).
+    The folder where the rendered file(s) will be saved (messageStructure.png, .svg or .pdf).
+
+    -f outputFormat|--format=outputFormat
+    The format of the rendered file(s) - 'png', 'svg' or 'pdf' (default = 'png').
+    The 'svg' and 'pdf' formats are vector drawings, which are not rasterized.
 
     -v loggingLevel|--verbose=loggingLevel
     Set the level of logging that you want.
@@ -46,8 +51,16 @@ import os
 import sys
 import logging
 import argparse
-from xml.etree import ElementTree as et
-import matplotlib.pyplot as plt
+import functools
+from lxml import etree as et
+import numpy as np
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_svg import FigureCanvasSVG
+from matplotlib.backends.backend_pdf import FigureCanvasPdf
+from matplotlib.collections import LineCollection, PatchCollection
+from matplotlib.patches import FancyArrow, Rectangle
 
 # This next section is plagurised from /usr/include/sysexits.h
 EX_OK = 0               # successful termination
@@ -70,125 +83,166 @@ EX_NOPERM = 77          # permission denied
 EX_CONFIG = 78          # configuration error
 
 namespaces={'xsd':'http://www.w3.org/2001/XMLSchema'}   # The namespaces in the XSD message structure definition
-messageRoot = None      # The root of the XSD message structure definition
+xsd = '{' + namespaces['xsd'] + '}'     # The XSD namespace, in Clark notation, for tag lookups without any path parsing
+canvases = {'png':FigureCanvasAgg, 'svg':FigureCanvasSVG, 'pdf':FigureCanvasPdf}     # The canvas for each output format - none need a GUI backend
+xsdParser = et.XMLParser(remove_blank_text=True, remove_comments=True, remove_pis=True, collect_ids=False)   # The parser for the XSD message structure definition
+contentTypes = {}       # The complexTypes in the XSD message structure definition, indexed by name
+trainLines = []         # The lines (lists of points) that make up the train diagram
+trainArrows = []        # The arrow heads on the optional and repeat lines
+trainBoxes = []         # The left, right and centre height of each segment box
+trainLabels = []        # The position, text and rotation of the segment names and line joiners
+groupBoxes = {}         # The boxes for each segment grouping, at depth 0, indexed by name
 
 
 
-def drawBox(boxPlt, boxX1, boxX2, boxY, text):
+def drawBox(boxX1, boxX2, boxY, text):
     '''
     Draw a box, centred on a line at height boxY, at a point boxX, with a segment name inside
     '''
     logging.info('Renderining box(%s) from %d to %d at height %d', text, boxX1, boxX2, boxY)
-    thisX = [boxX1, boxX2, boxX2, boxX1, boxX1]
-    thisY = [boxY + 50, boxY + 50, boxY - 50, boxY - 50, boxY + 50]
-    boxPlt.plot(thisX, thisY, color='0')
-    boxPlt.text(boxX1 + 30, boxY, text, color='0')
+    trainBoxes.append((boxX1, boxX2, boxY))
+    trainLabels.append((boxX1 + 30, boxY, text, 0))
     return
 
 
-def drawOptional(optPlt, optX1, optX2, optY, optDepth):
+def drawOptional(optX1, optX2, optY, optDepth):
     '''
     Draw an 'optional' arrow on a line at heigh optY, below boxes from optX1 to optX2
     '''
     logging.info('Rendering optional line from %d to %d at height %d with dept %d',
                   optX1, optX2, optY, optDepth)
     down = optY - 50 - (optDepth * 10)
-    thisX = [optX1, optX1, optX2]
-    thisY = [optY, down, down]
-    optPlt.plot(thisX, thisY, color='0')
-    optPlt.arrow(optX2, down, 0, optY - down - 4, length_includes_head=True, head_width=5, color='0', linewidth=1)
+    trainLines.append([(optX1, optY), (optX1, down), (optX2, down)])
+    trainArrows.append(FancyArrow(optX2, down, 0, optY - down - 4, length_includes_head=True, head_width=5, color='0', linewidth=1))
     return
 
 
-def drawRepeat(rptPlt, rptX1, rptX2, rptY, rptDepth):
+def drawRepeat(rptX1, rptX2, rptY, rptDepth):
     '''
     Draw an 'repeat' arrow on a line at heigh optY, below boxes from optX2 back to optX1
     '''
     logging.info('Rendering repeat line from %d to %d at height %d with dept %d',
                   rptX1, rptX2, rptY, rptDepth)
     up = rptY + 50 + (rptDepth * 10)
-    thisX = [rptX2, rptX2, rptX1]
-    thisY = [rptY, up, up]
-    rptPlt.plot(thisX, thisY, color='0')
-    rptPlt.arrow(rptX1, up, 0, rptY - up + 4, length_includes_head=True, head_width=5, color='0', linewidth=1)
+    trainLines.append([(rptX2, rptY), (rptX2, up), (rptX1, up)])
+    trainArrows.append(FancyArrow(rptX1, up, 0, rptY - up + 4, length_includes_head=True, head_width=5, color='0', linewidth=1))
     return
 
 
-def getBoxes(sequence, depth):
+def getGroupBoxes(groupName):
     '''
-    Get the boxes associated with this segment grouping
+    Get the boxes associated with this segment grouping, as if the segment grouping was at depth 0
+    Segment groupings can be used many times in a message structure, so they are only worked out once.
+    Nested segment groupings are worked out first, using a stack rather than recursion
+    PARAMETERS:
+        groupName - str, the name of the segment grouping
+    RETURNS:
+        thisLength - int, the length of the segment grouping
+        maxDepth - int, the depth of the deepest segment grouping nested within this segment grouping
+        chain - list, the boxes in this segment grouping
     '''
-    maxDepth = depth
-    chain = []
-    thisLength = 0      # Total length of everything
-    for ii, element in enumerate(sequence):
-        chainBox = {}
-        name = element.attrib['ref']
-        opt = element.attrib['minOccurs']
-        rpt = element.attrib['maxOccurs']
-        chainBox['name'] = element.attrib['ref']
-        chainBox['minOccurs'] = element.attrib['minOccurs']
-        chainBox['maxOccurs'] = rpt
+    if groupName in groupBoxes:
+        return groupBoxes[groupName]
+    stack = [{'name':groupName, 'sequence':contentTypes[groupName + '.CONTENT'].find(xsd + 'sequence'), 'at':0, 'maxDepth':0, 'chain':[], 'thisLength':0}]
+    while len(stack) > 0:
+        frame = stack[-1]
+        sequence = frame['sequence']
+        ii = frame['at']
+        if ii == len(sequence):       # All the boxes in this segment grouping have been worked out
+            groupBoxes[frame['name']] = (frame['thisLength'], frame['maxDepth'], frame['chain'])
+            del stack[-1]
+            continue
+        attrib = sequence[ii].attrib
+        name = attrib['ref']
+        optional = (attrib['minOccurs'] == '0')
+        repeat = (attrib['maxOccurs'] == 'unbounded')
+        chainBox = {'name':name, 'optional':optional, 'repeat':repeat, 'needsArrow':optional or repeat, 'depth':1}
         if len(name) == 3:      # A segment
-            chainBox['depth'] = 1
             chainBox['length'] = 100
-            thisLength += 100
-            if (opt == '0') or (rpt == 'unbounded'):
-                thisLength += 20
-            if ii < (len(sequence) - 1):
-                thisLength += 50
-            chainBox['maxDepth'] = 1
-            chain.append(chainBox)
-            continue
-        childSequence = messageRoot.find("xsd:complexType[@name='" + name + ".CONTENT']/xsd:sequence", namespaces)
-        if childSequence is None:       # Must be a choice - single box
-            childSequence = messageRoot.find("xsd:complexType[@name='" + name + ".CONTENT']/xsd:choice", namespaces)
-            name = ''
-            choiceLen = 0
-            for choice in childSequence:
-                if name != '':
-                    name += '|'
-                    choiceLen += 10
-                name += choice.attrib['ref']
-                choiceLen += 45
-            chainBox['name'] = name
-            chainBox['depth'] = 1
-            chainBox['length'] = choiceLen
-            thisLength += choiceLen
-            if (opt == '0') or (rpt == 'unbounded'):
-                thisLength += 20
-            if ii < (len(sequence) - 1):
-                thisLength += 50
             chainBox['maxDepth'] = 1
-            chain.append(chainBox)
-            continue
-        # Group of a sequence of segments/segment groups
-        childLength, newDepth, newChain = getBoxes(childSequence, depth + 1)
-        logging.info('Group of segments called %s, length %d, at depth %d, newDepth %d, chain:%s', name, childLength, depth + 1, newDepth, repr(newChain))
-        if newDepth > maxDepth:
-            maxDepth = newDepth
-        chainBox['depth'] = depth + 1
-        chainBox['length'] = childLength
-        thisLength += chainBox['length']
-        if (opt == '0') or (rpt == 'unbounded'):
+        else:
+            complexType = contentTypes.get(name + '.CONTENT')
+            childSequence = complexType.find(xsd + 'sequence')
+            if childSequence is None:       # Must be a choice - single box
+                choices = [choice.attrib['ref'] for choice in complexType.find(xsd + 'choice')]
+                chainBox['name'] = '|'.join(choices)
+                chainBox['length'] = len(choices) * 45 + max(len(choices) - 1, 0) * 10
+                chainBox['maxDepth'] = 1
+            else:           # Group of a sequence of segments/segment groups
+                if name not in groupBoxes:      # Work out the nested segment grouping first, then come back to this element
+                    if len(stack) > 200:
+                        logging.critical('Message structure nested too deeply at group (%s)', name)
+                        logging.shutdown()
+                        sys.exit(EX_CONFIG)
+                    stack.append({'name':name, 'sequence':childSequence, 'at':0, 'maxDepth':0, 'chain':[], 'thisLength':0})
+                    continue
+                childLength, newDepth, newChain = getBoxes(name, 1)
+                logging.info('Group of segments called %s, length %d, at depth %d, newDepth %d, chain:%s', name, childLength, 1, newDepth, newChain)
+                if newDepth > frame['maxDepth']:
+                    frame['maxDepth'] = newDepth
+                chainBox['length'] = childLength
+                chainBox['chain'] = newChain
+                chainBox['maxDepth'] = frame['maxDepth']
+        # Allow for the box, any arrows and the gap to the next box
+        thisLength = chainBox['length']
+        if chainBox['needsArrow']:
             thisLength += 20
         if ii < (len(sequence) - 1):
             thisLength += 50
-        chainBox['chain'] = newChain
-        chainBox['maxDepth'] = maxDepth
-        chain.append(chainBox)
-    return thisLength, maxDepth, chain
+        frame['thisLength'] += thisLength
+        frame['chain'].append(chainBox)
+        frame['at'] += 1
+    return groupBoxes[groupName]
 
 
-def renderBoxes(boxPlt, boxList, startX, thisY, maxDepth):
+def shiftBoxes(chain, depth):
+    '''
+    Copy a chain of boxes, moving the segment groupings in the chain down by depth
+    PARAMETERS:
+        chain - list, the boxes in a segment grouping
+        depth - int, the depth to add to each segment grouping
+    RETURNS:
+        newChain - list, a copy of the boxes in the segment grouping
+    '''
+    newChain = []
+    stack = [(chain, newChain)]
+    while len(stack) > 0:
+        oldBoxes, newBoxes = stack.pop()
+        for chainBox in oldBoxes:
+            newBox = dict(chainBox)
+            if 'chain' in chainBox:     # A segment grouping - copy its chain of boxes as well
+                newBox['depth'] += depth
+                newBox['maxDepth'] += depth
+                newBox['chain'] = []
+                stack.append((chainBox['chain'], newBox['chain']))
+            newBoxes.append(newBox)
+    return newChain
+
+
+def getBoxes(name, depth):
+    '''
+    Get the boxes associated with this segment grouping
+    PARAMETERS:
+        name - str, the name of the segment grouping
+        depth - int, the depth of this segment grouping
+    RETURNS:
+        thisLength - int, the length of the segment grouping
+        maxDepth - int, the depth of the deepest segment grouping nested within this segment grouping
+        chain - list, the boxes in this segment grouping
+    '''
+    thisLength, maxDepth, chain = getGroupBoxes(name)
+    return thisLength, maxDepth + depth, shiftBoxes(chain, depth)
+
+
+def renderBoxes(boxList, startX, thisY, maxDepth):
     '''
     Render a list of boxes on a line at thisY, starting at position startX on that line
     PARAMETERS:
-        boxPlt - matplotlib pyplot
         boxList - list, list of block structures to render
         startX - int, start of line position
         thisY - int, current line height
     '''
+    logInfo = logging.getLogger().isEnabledFor(logging.INFO)      # Only gather the logging details if they will be logged
     endX = startX
     for ii, thisBox in enumerate(boxList):
         thisX = endX
@@ -197,40 +251,165 @@ def renderBoxes(boxPlt, boxList, startX, thisY, maxDepth):
         if thisBox['depth'] == 1:
             realDepth = 1
             endX += thisBox['length']
-            logging.info('Rendering group block(%s), opt(%s), rpt(%s), depth(%s), maxDepth(%d), length(%d)',
-                            thisBox['name'], thisBox['minOccurs'], thisBox['maxOccurs'], thisBox['depth'], maxDepth, thisBox['length'])
-            drawBox(boxPlt, thisX, endBox, thisY, thisBox['name'])
+            if logInfo:
+                logging.info('Rendering group block(%s), optional(%s), repeat(%s), depth(%s), maxDepth(%d), length(%d)',
+                                thisBox['name'], thisBox['optional'], thisBox['repeat'], thisBox['depth'], maxDepth, thisBox['length'])
+            drawBox(thisX, endBox, thisY, thisBox['name'])
         else:
-            logging.info('Rendering group of block(%s), opt(%s), rpt(%s), depth(%s), maxDepth(%d), length(%d)',
-                            thisBox['name'], thisBox['minOccurs'], thisBox['maxOccurs'], thisBox['depth'], maxDepth, thisBox['length'])
-            newX = renderBoxes(boxPlt, thisBox['chain'], endX, thisY, maxDepth)
-            logging.info('Block rendered at %d, of length %d, endX now %d, endBox(%d)', endX, thisBox['length'], newX, endBox)
+            if logInfo:
+                logging.info('Rendering group of block(%s), optional(%s), repeat(%s), depth(%s), maxDepth(%d), length(%d)',
+                                thisBox['name'], thisBox['optional'], thisBox['repeat'], thisBox['depth'], maxDepth, thisBox['length'])
+            newX = renderBoxes(thisBox['chain'], endX, thisY, maxDepth)
+            if logInfo:
+                logging.info('Block rendered at %d, of length %d, endX now %d, endBox(%d)', endX, thisBox['length'], newX, endBox)
             endX = newX
         x0 = endBox
         x1 = endBox
         if ii < (len(boxList) - 1):     # Not the last box
             x1 += 50
-            if (boxList[ii + 1]['minOccurs'] == '0') or (boxList[ii + 1]['maxOccurs'] == 'unbounded'):
+            if boxList[ii + 1]['needsArrow']:
                 x1 += 10
-        if (thisBox['minOccurs'] == '0') or (thisBox['maxOccurs'] == 'unbounded'):      # Need arrow(s)
+        if thisBox['needsArrow']:      # Need arrow(s)
             x1 += 10
         if x0 != x1:
             endX = x1
-            boxX = [x0, x1]
-            boxY = [thisY, thisY]
             logging.info('End of block line from %d to %d at height %d', x0, x1, thisY)
-            plt.plot(boxX, boxY, color='0')
-        if (thisBox['minOccurs'] == '0') or (thisBox['maxOccurs'] == 'unbounded'):      # Need arrow(s)
+            trainLines.append([(x0, thisY), (x1, thisY)])
+        if thisBox['needsArrow']:      # Need arrow(s)
             x0 = thisX - 10
             x1 = endBox + 10
-            if thisBox['minOccurs'] == '0':              # Need optional arrow
-                drawOptional(boxPlt, x0, x1, thisY, realDepth)
-            if thisBox['maxOccurs'] == 'unbounded':       # Need repeat arrow
-                drawRepeat(boxPlt, x0, x1, thisY, realDepth)
+            if thisBox['optional']:              # Need optional arrow
+                drawOptional(x0, x1, thisY, realDepth)
+            if thisBox['repeat']:       # Need repeat arrow
+                drawRepeat(x0, x1, thisY, realDepth)
     logging.info('Returning endX at %d', endX)
     return endX
 
 
+@functools.lru_cache(maxsize=None)
+def loadStructure(xsdFile):
+    '''
+    Read in an XML Schema message structure definition (only once, no matter how often the message structure is rendered)
+    PARAMETERS:
+        xsdFile - str, the XML Schema message structure definition file
+    RETURNS:
+        complexTypes - dict, the complexTypes in the message structure definition, indexed by name
+    '''
+    messageTree = et.parse(xsdFile, xsdParser)
+    messageRoot = messageTree.getroot()
+    complexTypes = {}
+    for complexType in messageRoot.iterfind(xsd + 'complexType'):
+        complexTypes[complexType.attrib['name']] = complexType
+    return complexTypes
+
+
+def renderStructure(schemaDir, msgStruct, outputDir, outputFormat):
+    '''
+    Read in an XML Schema message structure definition, render it as a train diagram and save it as an image file
+    PARAMETERS:
+        schemaDir - str, the folder containing the HL7 v2.xml XML Schema files
+        msgStruct - str, the name of the message structure
+        outputDir - str, the folder where the image file will be saved
+        outputFormat - str, the format of the image file ('png', 'svg' or 'pdf')
+    '''
+    global contentTypes, trainLines, trainArrows, trainBoxes, trainLabels
+
+    # Read in the message structure and start a new diagram
+    contentTypes = loadStructure(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd'))
+    groupBoxes.clear()
+    trainLines = []
+    trainArrows = []
+    trainBoxes = []
+    trainLabels = []
+    segmentList = contentTypes[msgStruct + '.CONTENT'].find(xsd + 'sequence')
+
+    # Check that the definintion starts with MSH
+    if segmentList[0].attrib['ref'] != 'MSH' :
+        logging.critical('MSH not defined for messages structure(%s)', msgStruct)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+
+    # Now create the HL7 v2.x train diagram
+    maxLength, deepestDepth, boxChain = getBoxes(msgStruct, 1)
+
+    logInfo = logging.getLogger().isEnabledFor(logging.INFO)      # Only gather the logging details if they will be logged
+
+    # Layout the boxes on lines on the page
+    # Each line is filled with boxes, and the line depth tracked, using the box properties as arrays
+    boxLengths = np.array([box['length'] for box in boxChain])
+    boxDepths = np.array([box['depth'] for box in boxChain])
+    boxMaxDepths = np.array([box['maxDepth'] for box in boxChain])
+    boxWidths = boxLengths + boxDepths * 20 + 50        # The width of each box, with its arrows and the gap after it
+    boxEnds = np.cumsum(boxWidths)                      # Where each box would end if all the boxes were on one line
+    lines = []
+    maxX = 1600
+    X = 50
+    Y = 100
+    start = 0
+    while start < len(boxChain):
+        if start > 0:           # Time for a new line
+            X = 80          # Allow for lead-in tilda
+            Y = lines[-1]['Y'] + 150 + lines[-1]['maxDepth'] * 10        # Allow for any repeat arrows
+            Y += boxDepths[start] * 10
+            if (X + boxWidths[start] + 50) > maxX:
+                maxX = int((X + boxWidths[start] + 50 + 99) / 100) * 100
+        # A box fits on this line if it ends before 1300 (excluding the gap after it) - but there's always at least one box
+        lineStart = boxEnds[start] - boxWidths[start]
+        end = max(start + 1, int(np.searchsorted(boxEnds, lineStart + 1300 + 50 - X)))
+        # Allow for any optional arrows on boxes deeper than the preceding boxes on this line
+        lineDepths = np.maximum.accumulate(boxMaxDepths[start:end])
+        deeper = boxMaxDepths[start + 1:end] > lineDepths[:-1]
+        Y += int(np.sum(boxDepths[start + 1:end][deeper] - lineDepths[:-1][deeper])) * 10
+        lines.append({'Y':int(Y), 'maxDepth':int(lineDepths[-1]), 'boxes':boxChain[start:end]})
+        if logInfo:
+            logging.info('New line - boxes(%d to %d), maxDepth(%d)', start, end - 1, lines[-1]['maxDepth'])
+        start = end
+
+    # Construct a page for this diagram
+    topY = int((lines[-1]['Y'] + 180 + lines[-1]['maxDepth'] * 10 + 99)/100) * 100
+    fig = Figure(figsize=(maxX / 100.0, topY / 100.0), dpi=100)
+    canvas = canvases[outputFormat](fig)
+    ax = fig.add_subplot()
+    ax.axis('off')
+    ax.set_xlim((0, maxX))
+    ax.set_ylim((0, topY))
+    ax.text(int(maxX / 20) * 10, topY - 20, msgStruct)
+
+    # Render the lines on this page
+    # Lines are rendered top down (lines[-1] is the last line at the bottom of the canvas)
+    for i, line in enumerate(lines):
+        if logInfo:
+            logging.info('Rendering line %d of boxes with boxes %s', i, line)
+        Y = topY - line['Y']
+        X = 80
+        if i > 0:        # Starting a second, or subsequent line = start with the joiner character
+            trainLabels.append((20, Y, '~', 90))
+            trainLines.append([(35, Y), (80, Y)])
+        # Render each block, or group of blocks
+        X = renderBoxes(line['boxes'], X, Y, line['maxDepth'])
+        if i < (len(lines) - 1):      # Not the last line - need a tilda
+            trainLines.append([(X, Y), (X + 45, Y)])
+            trainLabels.append((X + 45, Y, '~', 90))
+        continue
+
+    # Draw all the labels, arrows and lines in one go
+    for labelX, labelY, label, labelRotation in trainLabels:
+        ax.text(labelX, labelY, label, rotation=labelRotation, color='0')
+    ax.add_collection(PatchCollection(trainArrows, match_original=True, joinstyle='miter', capstyle='butt'))
+    boxOutlines = [Rectangle((boxX1, boxY - 50), boxX2 - boxX1, 100) for boxX1, boxX2, boxY in trainBoxes]
+    ax.add_collection(PatchCollection(boxOutlines, facecolors='none', edgecolors='0', linewidths=matplotlib.rcParams['lines.linewidth'],
+                                      joinstyle=matplotlib.rcParams['lines.solid_joinstyle']))
+    ax.add_collection(LineCollection(trainLines, colors='0', linewidths=matplotlib.rcParams['lines.linewidth'],
+                                    capstyle=matplotlib.rcParams['lines.solid_capstyle'], joinstyle=matplotlib.rcParams['lines.solid_joinstyle']))
+
+    # Save the rendered image
+    outputFilename = msgStruct + '.' + outputFormat
+    if outputDir is not None:
+        outputFilename = os.path.join(outputDir, outputFilename)
+    canvas.print_figure(outputFilename, format=outputFormat)
+    return
+
+
 if __name__ == '__main__':
     '''
     The main code
@@ -244,10 +423,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='bar2xml')
     parser.add_argument('-S', '--schemaDir', dest='schemaDir', default='schema/v2.4',
                         help='The folder containing the HL7 v2.xml XML schema files (default="schema/v2.4")')
-    parser.add_argument('-m', '--messageStructure', required=True, dest='messageStructure',
-                        help='The name of the HL7 v2.xml message structure file')
+    parser.add_argument('-m', '--messageStructure', required=True, dest='messageStructure', nargs='+',
+                        help='The name(s) of the HL7 v2.xml message structure file(s)')
     parser.add_argument('-O', '--outputDir', dest='outputDir', default='.',
-                        help='The folder where the ".png" file will be saved (messageStructure.png)')
+                        help='The folder where the rendered file(s) will be saved (messageStructure.png, .svg or .pdf)')
+    parser.add_argument('-f', '--format', dest='outputFormat', default='png', choices=['png', 'svg', 'pdf'],
+                        help='The format of the saved file (default="png")')
     parser.add_argument ('-v', '--verbose', dest='verbose', type=int, choices=range(0,5),
                          help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=info')
     parser.add_argument ('-L', '--logDir', dest='logDir', default='.', metavar='logDir',
@@ -257,8 +438,9 @@ if __name__ == '__main__':
     # Parse the command line
     args = parser.parse_args()
     schemaDir = args.schemaDir
-    msgStruct = args.messageStructure
+    msgStructures = args.messageStructure
     outputDir = args.outputDir
+    outputFormat = args.outputFormat
     logDir = args.logDir
     logFile = args.logFile
     loggingLevel = args.verbose
@@ -292,93 +474,13 @@ if __name__ == '__main__':
         logging.shutdown()
         sys.exit(EX_CONFIG)
 
-    # Check that the message structure file exists and read it in
-    if not os.path.isfile(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd')):
-        logging.critical('Unknown message structure (%s)', msgStruct)
-        logging.shutdown()
-        sys.exit(EX_DATAERR)
-    messageTree = et.parse(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd'))
-    messageRoot = messageTree.getroot()
-    segmentList = messageRoot.find("xsd:complexType[@name='" + msgStruct + ".CONTENT']/xsd:sequence", namespaces)
-
-    # Check that the definintion starts with MSH
-    if segmentList[0].attrib['ref'] != 'MSH' :
-        logging.critical('MSH not defined for messages structure(%s)', msgStruct)
-        logging.shutdown()
-        sys.exit(EX_CONFIG)
-
-    # Now create the HL7 v2.x train diagram
-    maxLength, deepestDepth, boxChain = getBoxes(segmentList, 1)
-
-    # Layout the boxes on lines on the page
-    lines = []
-    lines.append({})
-    maxX = 1600
-    X = 50
-    Y = 100
-    first = True
-    for box in boxChain:
-        if first:
-            X = 50
-            Y = 100
-            lines[0]['Y'] = Y
-            lines[0]['maxDepth'] = box['maxDepth']
-            lines[0]['boxes'] = []
-            logging.info('New line - maxDepth(%d)', lines[0]['maxDepth'])
-            first = False
-        if (X + box['length'] + box['depth'] * 20) < 1300:  # Another box set for this line
-            logging.info('Appending another box to line - name(%s), maxDepth(%d)', box['name'], box['maxDepth'])
-            box['X'] = X + box['depth'] * 10
-            lines[0]['boxes'].append(box)
-            logging.info('Comparing this box maxDepth(%s) with current line maxDepth(%d)', box['maxDepth'], lines[0]['maxDepth'])
-            if box['maxDepth'] > lines[0]['maxDepth']:
-                lines[0]['Y'] += (box['depth'] - lines[0]['maxDepth']) * 10      # Allow for any optional arrows
-                lines[0]['maxDepth'] = box['maxDepth']
-            X += box['length'] + box['depth'] * 20 + 50
-        else:           # Time for a new line
-            X = 80          # Allow for lead-in tilda
-            Y = lines[0]['Y'] + 150 + lines[0]['maxDepth'] * 10        # Allow for any repeat arrows
-            lines.insert(0, {})
-            lines[0]['Y'] = Y + box['depth'] * 10
-            lines[0]['maxDepth'] = box['maxDepth']
-            lines[0]['boxes'] = []
-            lines[0]['boxes'].append(box)
-            logging.info('New line - maxDepth(%d)', lines[0]['maxDepth'])
-            X += box['length'] + box['depth'] * 20 + 50
-            if (X + 50) > maxX:
-                maxX = int((X + 50 + 99) / 100) * 100
-
-    # Construct a page for this diagram
-    topY = int((lines[0]['Y'] + 180 + lines[0]['maxDepth'] * 10 + 99)/100) * 100
-    fig, ax = plt.subplots(figsize=(maxX / 100.0, topY / 100.0), dpi=100)      # canvas
-    plt.axis('off')
-    plt.xlim((0, maxX))
-    plt.ylim((0, topY))
-    plt.text(int(maxX / 20) * 10, topY - 20, msgStruct)
+    # Check that the message structure file(s) exist
+    for msgStruct in msgStructures:
+        if not os.path.isfile(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd')):
+            logging.critical('Unknown message structure (%s)', msgStruct)
+            logging.shutdown()
+            sys.exit(EX_DATAERR)
 
-    # Render the lines on this page
-    # Lines are rendered in reverse order (lines[0] is the last line at the bottom of the canvas)
-    for i, line in enumerate(lines):
-        logging.info('Rendering line %d of boxes with boxes %s', i, repr(line))
-        Y = topY - line['Y']
-        X = 80
-        if i < (len(lines) - 1):        # Starting a second, or subsequent line = start with the joiner character
-            plt.text(20, Y, '~', rotation=90, color='0')
-            x = [35, 80]
-            y = [Y, Y]
-            plt.plot(x, y, color='0')
-        # Render each block, or group of blocks
-        X = renderBoxes(plt, line['boxes'], X, Y, line['maxDepth'])
-        if i > 0:      # Not the last line - need a tilda
-            x = [X, X + 45]
-            y = [Y, Y]
-            plt.plot(x, y, color='0')
-            plt.text(X + 45, Y, '~', rotation=90, color='0')
-        continue
-
-    # Save the rendered image
-    outputFilename = msgStruct + '.png'
-    if outputDir is not None:
-        outputFilename = os.path.join(outputDir, outputFilename)
-    plt.savefig(outputFilename)
-    # plt.show()
+    # Render each message structure as a train diagram
+    for msgStruct in msgStructures:
+        renderStructure(schemaDir, msgStruct, outputDir, outputFormat)
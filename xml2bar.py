@@ -12,6 +12,7 @@ or all the message files in a folder.
     $ python xml2bar.py [-I inputDir|--inputDir=inputDir]
         [-i inputFile|--inputFile=inputFile]
         [-O outputDir|--outputDir=outputDir]
+        [-u|--update]
         [-v loggingLevel|--verbose=logingLevel]
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
@@ -31,6 +32,9 @@ or all the message files in a folder.
     -O outputDir|--outputDir=outputDir
     The folder where the output file(s) will be created.
 
+    -u|--update
+    Only convert the message files that are newer than their existing output file.
+
     -v loggingLevel|--verbose=loggingLevel
     Set the level of logging that you want.
 
@@ -48,7 +52,9 @@ import sys
 import logging
 import argparse
 import re
-from xml.etree import ElementTree as et
+import itertools
+import concurrent.futures
+from lxml import etree as et
 
 # This next section is plagurised from /usr/include/sysexits.h
 EX_OK = 0               # successful termination
@@ -70,70 +76,128 @@ EX_PROTOCOL = 76        # remote error in protocol
 EX_NOPERM = 77          # permission denied
 EX_CONFIG = 78          # configuration error
 
-Segments = []           # The Segments in the message being converted
-segmentNo = 0           # The next segment in the message to be converted
 fieldSep = None         # The field separator character
 repSep = None           # The repeat separator
 escSep = None           # The escape delimiter
 compSep = None          # The component separator
 subCompSep = None       # The subcomponent separator
-hl7charRef = re.compile(r'&#x(([0-9A-Fa-f][0-9A-Fa-f])+);')
-removeNamespace = re.compile(r' xmlns="[^"]+"')
+hl7Rewrite = re.compile(r'&#x(([0-9A-Fa-f][0-9A-Fa-f])+);| xmlns="[^"]+"')   # Character references and the default namespace
+blockSize = 65536       # The number of characters to read from the message at a time
+tagNumbers = {}         # The field/component/subcomponent number for each tag seen so far
+
 
 
+def rewriteMatch(match):
+    '''
+    Replace a character reference with an HL7 hexadecimal escape sequence, and remove the default namespace
+    '''
+    hexDigits = match.group(1)
+    if hexDigits is None:
+        return ''
+    return '\\X' + hexDigits + '\\'
+
 
 def getDocument(fileName):
     '''
     Get an HL7 v2.xml XML tagged message from a file or standard input
+    Yield each child of the message element (a segment or a segment group) as soon as it has been parsed
     '''
-    thisHL7message = ''
     if fileName == '-':     # Use standard input
-        for line in sys.stdin:
-            thisHL7message += line.strip()
+        yield from parseDocument(sys.stdin)
     else:
         if not os.path.isfile(fileName):
             logging.fatal('No file named %s', fileName)
             logging.shutdown()
             sys.exit(EX_CONFIG)
         with open(fileName, 'rt', encoding='utf-8') as fpin:
-            for line in fpin:
-                thisHL7message += line.strip()
-    thisHL7message = hl7charRef.sub(r'\\X\1\\', thisHL7message)
-    thisHL7message = removeNamespace.sub('', thisHL7message)
+            yield from parseDocument(fpin)
+
+
+def parseDocument(fpin):
+    '''
+    Parse an HL7 v2.xml XML tagged message, a block at a time, as it is read
+    Each line is stripped of leading and trailing white space, as indentation is not part of the message
+    Each child of the message element is yielded when it ends, and is cleared once it has been converted,
+    so that only the part of the message that is being converted is held in memory
+    '''
+    xmlParser = et.XMLPullParser(events=('start', 'end'), remove_comments=True, remove_pis=True, huge_tree=True)
+    depth = 0
+    pending = ''
+    endOfMessage = False
     try:
-        thisHL7xml = et.fromstring(thisHL7message, )
-    except:
+        while not endOfMessage:
+            block = fpin.read(blockSize)
+            if block == '':
+                endOfMessage = True
+                block = pending.strip()
+            else:
+                # Strip the leading and trailing white space from each complete line, and carry any partial last line
+                # over to the next block, so that no line, reference or attribute is split across two blocks
+                lines = (pending + block).split('\n')
+                pending = lines.pop()
+                block = ''.join([line.strip() for line in lines])
+            if ('&#x' in block) or (' xmlns="' in block):
+                block = hl7Rewrite.sub(rewriteMatch, block)
+            xmlParser.feed(block.encode('utf-8'))
+            for event, element in xmlParser.read_events():
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    yield element
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+        xmlParser.close()
+    except (et.XMLSyntaxError, ValueError):
         logging.critical('Invalid XML input')
         logging.shutdown()
         sys.exit(EX_DATAERR)
-    return thisHL7xml
+
+
+def getTagNumber(tag):
+    '''
+    Get the field, component or subcomponent number from a tag (the number after the first '.')
+    HL7 v2.xml has a limited vocabulary of tags, so each number is only parsed the first time the tag is seen
+    '''
+    tagNumber = tagNumbers.get(tag)
+    if tagNumber is None:
+        tagNumber = int(tag[tag.find('.') + 1:])
+        tagNumbers[tag] = tagNumber
+    return tagNumber
 
 
 def getSegment(thisSegElement):
     '''
-    Construct the fields for this segment
+    Construct the fields for this segment, or for each segment in this segment group, and yield each segment
+    PARAMETERS:
+        thisSegElement - Element, a segment or segment group element
+    Nested segment groups are walked with an explicit stack, rather than recursively
+    Each segment is assembled as a list of parts, which are joined once at the end
     '''
-    thisSegment = thisSegElement.tag
-    if len(thisSegment) > 3:
-        for segChild in thisSegElement:
-            thisSegChild = getSegment(segChild)
-            if thisSegChild is not None:
-                Segments.append(thisSegChild)
-        return None
-    lastField = 0
-    for field in thisSegElement:        # The field or field group elements
-        if field.tag == 'MSH.1':        # Don't need the field separator as a separate field
-            lastField = 1
+    stack = [thisSegElement]
+    while stack:
+        segElement = stack.pop()
+        thisSegment = segElement.tag
+        if len(thisSegment) > 3:        # A segment group - walk its children next, in order
+            stack.extend(reversed(segElement))
             continue
-        fieldNo = int(field.tag[4:])
-        if fieldNo == lastField:
-            thisSegment += repSep
-        else:
-            while lastField < fieldNo:
-                thisSegment += fieldSep
-                lastField += 1
-        thisSegment += getField(field)
-    return thisSegment
+        parts = [thisSegment]
+        lastField = 0
+        for field in segElement:        # The field or field group elements
+            fieldTag = field.tag            # lxml creates a new string each time .tag is read
+            if fieldTag == 'MSH.1':         # Don't need the field separator as a separate field
+                lastField = 1
+                continue
+            fieldNo = getTagNumber(fieldTag)
+            if fieldNo == lastField:
+                parts.append(repSep)
+            elif fieldNo > lastField:
+                parts.append(fieldSep * (fieldNo - lastField))
+                lastField = fieldNo
+            parts.append(getField(field))
+        yield ''.join(parts)
 
 
 def getField(thisFieldElement):
@@ -141,10 +205,10 @@ def getField(thisFieldElement):
     Convert a field element into a HL7 vertical bar structured field
     '''
 
-    thisField = ''
-    if (len(thisFieldElement) == 0) or (thisFieldElement[0].tag =='escape'):
-        thisField += thisFieldElement.text
-        if len(thisFieldElement) > 0:
+    fieldChildren = len(thisFieldElement)
+    if (fieldChildren == 0) or (thisFieldElement[0].tag =='escape'):
+        parts = [thisFieldElement.text or '']      # An empty element has no text
+        if fieldChildren > 0:
             for fieldEsc in thisFieldElement:
                 if fieldEsc.tag != 'escape':
                     logging.critical('Illegal XML - field(%s) - "<escape>" and other tags in field', thisFieldElement.tag)
@@ -158,23 +222,22 @@ def getField(thisFieldElement):
                     logging.critical('Malformed XML - "<escape>" element in field(%s), but no Escape Delimiter defined in MSH', thisFieldElement.tag)
                     logging.shutdown()
                     sys.exit(EX_DATAERR)
-                thisField += escSep + fieldEsc.attrib['V'] + escSep
+                parts.extend((escSep, fieldEsc.attrib['V'], escSep))
                 if fieldEsc.tail is not None:
-                    thisField += fieldEsc.tail
-        return thisField
+                    parts.append(fieldEsc.tail)
+        return ''.join(parts)
+    parts = []
     lastCompNo = 1
     for thisComponent in thisFieldElement:
-        thisComponentTag = thisComponent.tag
-        dotAt = thisComponentTag.find('.')
-        thisCompNo = int(thisComponentTag[dotAt + 1:])
-        while lastCompNo < thisCompNo:
-            thisField += compSep
-            lastCompNo += 1
-        if len(thisComponent) is None:
-            thisField += thisComponent.text
+        thisCompNo = getTagNumber(thisComponent.tag)
+        if lastCompNo < thisCompNo:
+            parts.append(compSep * (thisCompNo - lastCompNo))
+            lastCompNo = thisCompNo
+        if len(thisComponent) == 0:      # A simple component - no subcomponents or escapes
+            parts.append(thisComponent.text or '')
         else:
-            thisField += getComponent(thisComponent)
-    return thisField
+            parts.append(getComponent(thisComponent))
+    return ''.join(parts)
 
 
 def getComponent(component):
@@ -182,54 +245,140 @@ def getComponent(component):
     Get a compond component
     '''
 
-    thisComp = ''
-    if (len(component) == 0) or (component[0].tag =='escape'):
-        thisComp += component.text
-        if len(component) > 0:
-            if thisComp.tag != 'escape':
-                logging.critical('Illegal XML - component(%s) - "<escape>" and other tags in component', component.tag)
-                logging.shutdown()
-                sys.exit(EX_DATAERR)
-            if 'V' not in thisComp.attrib:
-                logging.critical('Malformed "<escape>" tag in component(%s)', component.tag)
-                logging.shutdown()
-                sys.exit(EX_DATAERR)
-            if escSep is None:
-                logging.critical('Malformed XML - "<escape>" element in component(%s), but no Escape Delimiter defined in MSH', component.tag)
-                logging.shutdown()
-                sys.exit(EX_DATAERR)
+    compChildren = len(component)
+    if (compChildren == 0) or (component[0].tag =='escape'):
+        parts = [component.text or '']
+        if compChildren > 0:
             for compEsc in component:
-                thisComp += escSep + compEsc.attrib['V'] + escSep
+                if compEsc.tag != 'escape':
+                    logging.critical('Illegal XML - component(%s) - "<escape>" and other tags in component', component.tag)
+                    logging.shutdown()
+                    sys.exit(EX_DATAERR)
+                if 'V' not in compEsc.attrib:
+                    logging.critical('Malformed "<escape>" tag in component(%s)', component.tag)
+                    logging.shutdown()
+                    sys.exit(EX_DATAERR)
+                if escSep is None:
+                    logging.critical('Malformed XML - "<escape>" element in component(%s), but no Escape Delimiter defined in MSH', component.tag)
+                    logging.shutdown()
+                    sys.exit(EX_DATAERR)
+                parts.extend((escSep, compEsc.attrib['V'], escSep))
                 if compEsc.tail is not None:
-                    thisComp += compEsc.tail
-        return thisComp
+                    parts.append(compEsc.tail)
+        return ''.join(parts)
+    parts = []
     lastSubCompNo = 1
     for subComp in component:
-        subCompTag = subComp.tag
-        subCompDotAt = subCompTag.find('.')
-        thisSubCompNo = int(subCompTag[subCompDotAt + 1:])
-        while lastSubCompNo < thisSubCompNo:
-            thisComp += subCompSep
-            lastSubCompNo += 1
-        thisComp += subComp.text
+        thisSubCompNo = getTagNumber(subComp.tag)
+        if lastSubCompNo < thisSubCompNo:
+            parts.append(subCompSep * (thisSubCompNo - lastSubCompNo))
+            lastSubCompNo = thisSubCompNo
+        parts.append(subComp.text or '')
         if len(subComp) > 0:
             for subCompEsc in subComp:
-                if subComp.tag != 'escape':
+                if subCompEsc.tag != 'escape':
                     logging.critical('Illegal XML - component(%s) - "<escape>" and other tags in subcomponent', subComp.tag)
                     logging.shutdown()
                     sys.exit(EX_DATAERR)
-                if 'V' not in subComp.attrib:
+                if 'V' not in subCompEsc.attrib:
                     logging.critical('Malformed "<escape>" tag in subcomponent(%s)', subComp.tag)
                     logging.shutdown()
                     sys.exit(EX_DATAERR)
                 if escSep is None:
-                    logging.critical('Malformed XML - "<escape>" element in suncomponent(%s), but no Escape Delimiter defined in MSH', subComp.tag)
+                    logging.critical('Malformed XML - "<escape>" element in subcomponent(%s), but no Escape Delimiter defined in MSH', subComp.tag)
                     logging.shutdown()
                     sys.exit(EX_DATAERR)
-                thisComp += escSep + subCompEsc.attrib['V'] + escSep
+                parts.extend((escSep, subCompEsc.attrib['V'], escSep))
                 if subCompEsc.tail is not None:
-                    thisComp += subCompEsc.tail
-    return thisComp
+                    parts.append(subCompEsc.tail)
+    return ''.join(parts)
+
+
+def writeMessage(MSH, hl7xml, fpout):
+    '''
+    Convert the segments of the message, as the rest of the message is parsed,
+    and write out each segment as soon as it has been assembled
+    PARAMETERS:
+        MSH - Element, the MSH segment
+        hl7xml - generator, the rest of the segments and segment groups in the message
+        fpout - file, the output file
+    '''
+    logSegments = logging.getLogger().isEnabledFor(logging.INFO)
+    for child in itertools.chain((MSH,), hl7xml):
+        for segment in getSegment(child):
+            if logSegments:
+                logging.info(segment)
+            fpout.write(segment + '\r')
+
+
+def processMessage(messageFile, outputDir, update):
+    '''
+    Convert one HL7 v2.xml XML tagged message into an HL7 v2.x vertical bar encoded message
+    PARAMETERS:
+        messageFile - str, the file containing the HL7 v2.xml XML tagged message, or '-' for standard input
+        outputDir - str, the folder where the HL7 v2.x vertical bar encoded message will be created
+        update - boolean, only convert the message if it is newer than its existing output file
+    '''
+
+    global fieldSep, repSep, escSep, compSep, subCompSep
+
+    if messageFile != '-':
+        basename = os.path.basename(messageFile)
+        name, ext = os.path.splitext(basename)
+        outputFile = name + '.hl7'
+        if outputDir is not None:
+            outputFile = os.path.join(outputDir, outputFile)
+        elif outputFile == messageFile:
+            outputFile = 'HL7_' + outputFile
+        # Skip any message that has already been converted, and not changed since, if the -u option is specified
+        if update and os.path.isfile(messageFile) and os.path.isfile(outputFile):
+            if os.stat(outputFile).st_mtime_ns >= os.stat(messageFile).st_mtime_ns:
+                logging.info('%s is up to date', outputFile)
+                return
+    hl7xml = getDocument(messageFile)
+    MSH = next(hl7xml, None)
+    if (MSH is None) or (MSH.tag != 'MSH'):
+        logging.critical('Message missing MSH segment')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    # The separators are read from the MSH.1 and MSH.2 elements, as soon as the MSH segment has been parsed
+    if (len(MSH) < 1) or (MSH[0].tag != 'MSH.1') or (MSH[0].text is None):
+        logging.critical('Message missing MSH.1 [Field Separator] field')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    fieldSep = MSH[0].text
+    if (len(MSH) < 2) or (MSH[1].tag != 'MSH.2'):
+        logging.critical('Messing missing MSH.2 [Encoding Characters] field')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    delimiterCharacters = MSH[1].text or ''
+    if len(delimiterCharacters) < 2:
+        logging.critical('Insufficient message delimiter characters')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    compSep = delimiterCharacters[0:1]
+    repSep = delimiterCharacters[1:2]
+    if len(delimiterCharacters) > 2:
+        escSep = delimiterCharacters[2:3]
+    else:
+        escSep = None
+    if len(delimiterCharacters) > 3:
+        subCompSep = delimiterCharacters[3:4]
+    else:
+        subCompSep = None
+
+    # Now convert the message and save the HL7 V2.x vertical bar message, one segment at a time
+    if messageFile == '-':
+        writeMessage(MSH, hl7xml, sys.stdout)
+        sys.stdout.write('\n')
+    else:
+        with open(outputFile, 'wt', encoding='utf-8', newline='') as fpout:
+            try:
+                writeMessage(MSH, hl7xml, fpout)
+            except BaseException:
+                fpout.close()
+                os.remove(outputFile)       # Don't leave a partially converted message behind, whatever went wrong
+                raise
 
 
 if __name__ == '__main__':
@@ -250,6 +399,8 @@ if __name__ == '__main__':
                         help='The name of the HL7 v2.x vertical bar encoded message file')
     parser.add_argument('-O', '--outputDir', dest='outputDir', default='.',
                         help='The folder where the HL7 v2.xml XML tagged message(s) will be created (default=".")')
+    parser.add_argument('-u', '--update', dest='update', action='store_true',
+                        help='Only convert the message files that are newer than their existing output file')
     parser.add_argument ('-v', '--verbose', dest='verbose', type=int, choices=range(0,5),
                          help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=DEBUG')
     parser.add_argument ('-L', '--logDir', dest='logDir', default='.', metavar='logDir',
@@ -261,6 +412,7 @@ if __name__ == '__main__':
     inputDir = args.inputDir
     inputFile = args.inputFile
     outputDir = args.outputDir
+    update = args.update
     logDir = args.logDir
     logFile = args.logFile
     loggingLevel = args.verbose
@@ -270,16 +422,12 @@ if __name__ == '__main__':
     logfmt = progName + ' [%(asctime)s]: %(message)s'
     if loggingLevel is not None:    # Change the logging level from "WARN" if the -v vebose option is specified
         if logFile is not None:        # and send it to a file if the -o logfile option is specified
-            with open(os.path.join(logDir, logFile), 'wt', encoding='utf-8', newline='') as logOutput:
-                pass
-            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel], filename=os.path.join(logDir, logFile))
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel], filename=os.path.join(logDir, logFile), filemode='w', encoding='utf-8')
         else:
             logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel])
     else:
         if logFile is not None:        # send the default (WARN) logging to a file if the -o logfile option is specified
-            with open(os.path.join(logDir, logFile), 'wt', encoding='utf-8', newline='') as logOutput:
-                pass
-            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', filename=os.path.join(logDir, logFile))
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', filename=os.path.join(logDir, logFile), filemode='w', encoding='utf-8')
         else:
             logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p')
     logging.debug('Logging set up')
@@ -310,59 +458,10 @@ if __name__ == '__main__':
             for thisFile in os.listdir(inputDir):
                 hl7MessageFiles.append(os.path.join(inputDir, thisFile))
 
-    # Process each of these HL7 v2.x vertical bar encoded messages
-    for messageFile in hl7MessageFiles:
-        hl7xml = getDocument(messageFile)
-        MSH = hl7xml[0]
-        if MSH.tag != 'MSH':
-            logging.critical('Message missing MSH segment')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-        if MSH[0].tag != 'MSH.1':
-            logging.critical('Message missing MSH.1 [Field Separator] field')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-        fieldSep = MSH[0].text
-        if MSH[1].tag != 'MSH.2':
-            logging.critical('Messing missing MSH.2 [Encoding Characters] field')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-        delimiterCharacters = MSH[1].text
-        if len(delimiterCharacters) < 2:
-            logging.critical('Insufficient message delimiter characters')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-        compSep = delimiterCharacters[0:1]
-        repSep = delimiterCharacters[1:2]
-        if len(delimiterCharacters) > 2:
-            escSep = delimiterCharacters[2:3]
-        else:
-            escSep = None
-        if len(delimiterCharacters) > 3:
-            subCompSep = delimiterCharacters[3:4]
-        else:
-            subCompSep = None
-
-        # Now assemble the Segments
-        Segments = []
-        for child in hl7xml:
-            thisSeg = getSegment(child)
-            if thisSeg is not None:
-                Segments.append(thisSeg)
-
-        # Save the HL7 V2.x vertical bar message
-        if messageFile == '-':
-            hl7Message = '\r'.join(Segments) + '\r'
-            print(hl7Message)
-        else:
-            basename = os.path.basename(messageFile)
-            name, ext = os.path.splitext(basename)
-            outputFile = name + '.hl7'
-            if outputDir is not None:
-                outputFile = os.path.join(outputDir, outputFile)
-            elif outputFile == messageFile:
-                outputFile = 'HL7_' + outputFile
-            with open(outputFile, 'wt', encoding='utf-8', newline='\r') as fpout:
-                for seg in Segments:
-                    logging.info(seg)
-                    print(seg, file=fpout)
+    # Process each of these HL7 v2.xml XML tagged messages
+    # Every message is independent of every other message, so a folder of messages is converted by a pool of processes
+    if len(hl7MessageFiles) == 1:
+        processMessage(hl7MessageFiles[0], outputDir, update)
+    else:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            list(executor.map(processMessage, hl7MessageFiles, itertools.repeat(outputDir), itertools.repeat(update), chunksize=16))